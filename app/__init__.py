@@ -1,6 +1,10 @@
 from logging import getLogger
 from logging.config import dictConfig
 from . import config
+from .logs import install_queue
 
 dictConfig(config.LOGGING_CONFIG)
 logger = getLogger('telegram_cloud')
+log_queue = None
+if config.APP_LOG_QUEUE_ENABLED:
+    log_queue = install_queue(logger, config.APP_LOG_QUEUE_SIZE, config.APP_LOG_SAMPLE_RATE)
@@ -0,0 +1,51 @@
+from threading import Lock
+
+
+class AlbumBuffer:
+    """ Collects items of albums (media groups), that Telegram delivers as separate updates, so every album could be
+        saved at once after a short window
+    """
+    def __init__(self):
+        self._albums = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._albums)
+
+    def add(self, key, item) -> bool:
+        """ Add item to album
+
+        :param key: key of album, e.g. (chat id, media group id)
+        :param item: item to add
+        :return: True if it is the first item of album, so the album save should be scheduled
+        """
+        with self._lock:
+            album = self._albums.setdefault(key, [])
+            album.append(item)
+            return len(album) == 1
+
+    def pop(self, key) -> list:
+        """ Remove album from buffer
+
+        :param key: key of album
+        :return: items of album in the order they were added
+        """
+        with self._lock:
+            return self._albums.pop(key, [])
+
+
+class AlbumReady:
+    """ Event, that the window of an album is over. It is put to the dispatcher update queue, so the album is saved
+        by the handler worker of its chat, like updates are
+    """
+    def __init__(self, chat_id: int, user_id: int, media_group_id: str):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.media_group_id = media_group_id
+
+    @property
+    def key(self) -> tuple:
+        return self.chat_id, self.user_id, self.media_group_id
+
+
+ALBUM_BUFFER = AlbumBuffer()
@@ -0,0 +1,524 @@
+""" Export and import of user directory trees as newline-delimited JSON, optionally gzipped:
+
+    python -m app.backup export <telegram user id> --output backup.ndjson.gz --gzip
+    python -m app.backup import backup.ndjson.gz --user-id <telegram user id>
+"""
+import io
+import sys
+import gzip
+import json
+import time
+import argparse
+from collections import Counter
+from datetime import datetime
+from bson import Binary, ObjectId
+from bson.errors import InvalidId
+from mongoengine import signals
+from mongoengine.errors import ValidationError
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError
+from app import logger
+from app.errors import BackupFormatError, LeaseBusyError
+from app.config import CRYPTO, ROOT_DIRECTORY, EXPORT_BATCH_SIZE, IMPORT_PROGRESS_INTERVAL
+from app.models import Directory, File, Content, DIRECTORY_CACHE, SEARCH_CACHE
+
+FORMAT_VERSION = 1
+GZIP_MAGIC = b'\x1f\x8b'
+# fields of records, that are written by _default() as strings
+ID_FIELDS = ('id', 'parent', 'directory', 'content')
+DATETIME_FIELDS = ('created', 'updated', 'exported')
+
+
+def _default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _file_record(file: dict) -> dict:
+    """ Build export record of file. Telegram ids are stored encrypted with the key of deployment, so they are
+        decrypted to keep the export portable
+    """
+    return {
+        'type': 'file',
+        'id': file['_id'],
+        'directory': file['directory'],
+        'position': file.get('position'),
+        'media_type': file.get('media_type'),
+        'name': file.get('name'),
+        'content': file.get('content'),
+        'message_id': int(CRYPTO.decrypt(bytes(file['telegram_id']))),
+        'file_id': CRYPTO.decrypt(bytes(file['file_id'])).decode() if file.get('file_id') else None,
+        'created': file.get('created'),
+        'updated': file.get('updated'),
+    }
+
+
+def iter_records(user_id: int, batch_size: int = EXPORT_BATCH_SIZE):
+    """ Iterate over export records of user: manifest, content records, then directories in path order, so every
+        parent comes before its subdirectories, each followed by its files in upload order. Documents are read by
+        batched cursors and are not kept after they are yielded, so memory doesn't depend on size of the tree
+
+    :param user_id: telegram id of user
+    :param batch_size: amount of documents, fetched per one cursor batch
+    :return: generator of dicts
+    """
+    encrypted_user_id = Directory.encrypt_user_id(user_id)
+    yield {'type': 'manifest', 'version': FORMAT_VERSION, 'user_id': user_id, 'exported': datetime.utcnow()}
+
+    contents = Content._get_collection().find(
+        {'user_id': encrypted_user_id},
+        {'digest': 1, 'media_type': 1, 'mime_type': 1, 'size': 1, 'created': 1, 'updated': 1},
+        batch_size=batch_size
+    )
+    for content in contents:
+        yield {'type': 'content', 'id': content.pop('_id'), **content}
+
+    # directories, that are not migrated to paths or are being deleted, are skipped
+    directories = Directory._get_collection().find(
+        {'user_id': Binary(encrypted_user_id), 'path': {'$type': 'string'}, 'pending_delete': {'$ne': True}},
+        {'name': 1, 'parent': 1, 'path': 1, 'created': 1, 'updated': 1},
+        sort=[('path', 1)],
+        batch_size=batch_size
+    )
+    files_collection = File._get_collection()
+    for directory in directories:
+        directory_id = directory.pop('_id')
+        yield {'type': 'directory', 'id': directory_id, **directory}
+
+        files = files_collection.find(
+            {'directory': directory_id},
+            {
+                'telegram_id': 1, 'file_id': 1, 'media_type': 1, 'content': 1, 'name': 1, 'directory': 1,
+                'position': 1, 'created': 1, 'updated': 1
+            },
+            sort=[('position', 1)],
+            batch_size=batch_size
+        )
+        yield from map(_file_record, files)
+
+
+def iter_lines(records):
+    """ Serialize records to lines of newline-delimited JSON
+
+    :param records: generator of dicts (see iter_records())
+    :return: generator of encoded lines
+    """
+    for record in records:
+        yield json.dumps(record, default=_default, ensure_ascii=False, separators=(',', ':')).encode() + b'\n'
+
+
+def write_export(user_id: int, stream, compress: bool = False, batch_size: int = EXPORT_BATCH_SIZE) -> dict:
+    """ Write export of user to binary stream
+
+    :param user_id: telegram id of user
+    :param stream: binary file-like object
+    :param compress: compress export with gzip
+    :param batch_size: amount of documents, fetched per one cursor batch
+    :return: amount of exported records by type
+    """
+    counts = Counter()
+
+    def __counted(records):
+        for record in records:
+            counts[record['type']] += 1
+            yield record
+
+    output = gzip.GzipFile(fileobj=stream, mode='wb') if compress else stream
+    try:
+        for line in iter_lines(__counted(iter_records(user_id, batch_size))):
+            output.write(line)
+    finally:
+        if compress:
+            output.close()
+
+    return dict(counts)
+
+
+def _parse(record: dict) -> dict:
+    """ Restore ObjectIds and datetimes of record, that were serialized by _default()
+    """
+    for field in ID_FIELDS:
+        if record.get(field) is not None:
+            record[field] = ObjectId(record[field])
+    for field in DATETIME_FIELDS:
+        if record.get(field) is not None:
+            record[field] = datetime.fromisoformat(record[field])
+
+    return record
+
+
+def read_records(stream):
+    """ Iterate over records of export, written by write_export(). Gzip compression is detected by magic number,
+        lines are parsed one by one, so memory doesn't depend on size of the export
+
+    :param stream: binary file-like object
+    :return: generator of dicts, the first one is manifest
+    :raises BackupFormatError: if stream is not an export or is written by a newer version
+    """
+    if not hasattr(stream, 'peek'):
+        stream = io.BufferedReader(stream)
+    if stream.peek(len(GZIP_MAGIC))[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+
+    manifest = None
+    try:
+        for number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = _parse(json.loads(line))
+            except (ValueError, TypeError, AttributeError, InvalidId):
+                raise BackupFormatError(f'Line {number} is not an export record')
+
+            if manifest is None:
+                if record.get('type') != 'manifest':
+                    raise BackupFormatError('Export has no manifest')
+                if not isinstance(record.get('version'), int) or record['version'] > FORMAT_VERSION:
+                    raise BackupFormatError(f"Export version {record.get('version')} is not supported")
+                manifest = record
+            yield record
+    except (OSError, EOFError) as error:
+        raise BackupFormatError(f'Export could not be read: {error}')
+
+    if manifest is None:
+        raise BackupFormatError('Export is empty')
+
+
+def _insert_unordered(collection, documents: list) -> set:
+    """ Insert batch of documents with one unordered insert_many, that doesn't stop on documents, rejected by
+        unique indexes, so the rest of the batch is inserted anyway
+
+    :param collection: pymongo collection
+    :param documents: dicts or SONs to insert, ids are added to them
+    :return: indexes of documents, that are already stored
+    :raises BulkWriteError: if some of documents are not inserted for another reason
+    """
+    if not documents:
+        return set()
+
+    try:
+        collection.insert_many(documents, ordered=False)
+    except BulkWriteError as error:
+        if any(write_error['code'] != 11000 for write_error in error.details['writeErrors']):
+            raise
+        return {write_error['index'] for write_error in error.details['writeErrors']}
+
+    return set()
+
+
+class TreeImport:
+    """ Restore of export into the directory tree of a user. Records are buffered and written by unordered bulk
+        inserts, that fire pre_bulk_insert signals of models. Records get new ids, references between them are
+        rewritten by maps of exported ids, and parents of directories are set by one bulk update after all of
+        directories are inserted. Directories and files, that are already stored, are skipped by unique indexes,
+        so import of the same export again doesn't duplicate anything. Upload positions of files are reserved by
+        atomic increments of directory counters, so files are added after the stored ones and don't collide with
+        concurrent uploads. The tree lease is held for the whole import
+    """
+    def __init__(self, user_id: int, batch_size: int = EXPORT_BATCH_SIZE, progress=None,
+                 progress_interval: float = IMPORT_PROGRESS_INTERVAL):
+        """
+        :param user_id: telegram id of user, whose tree records are imported into
+        :param batch_size: amount of records, written by one bulk insert
+        :param progress: callback, that gets counts of imported records (see summary()) during import
+        :param progress_interval: min seconds between calls of progress callback
+        """
+        self.user_id = user_id
+        self.encrypted_user_id = Directory.encrypt_user_id(user_id)
+        self.batch_size = batch_size
+        self.progress = progress
+        self.progress_interval = progress_interval
+
+        self.buffers = {'content': [], 'directory': [], 'file': []}
+        # exported ids mapped to ids of stored records
+        self.contents = {}
+        self.directories = {}
+        # exported paths of directories to check, that every directory follows its parent
+        self.paths = {}
+        # stored ids of directories with exported ids of their parents
+        self.parents = []
+        self.references = Counter()
+        self.counts = Counter()
+        self.renew_lease = None
+        self.started = self.reported = time.monotonic()
+
+    def run(self, records) -> dict:
+        """ Import records
+
+        :param records: generator of records without manifest (see read_records())
+        :return: counts of imported records (see summary())
+        :raises BackupFormatError: if some of records are malformed
+        :raises LeaseBusyError: if the tree of user is changed by another worker
+        """
+        with Directory.lock_tree(self.encrypted_user_id) as self.renew_lease:
+            for record in records:
+                buffer = self.buffers.get(record.get('type'))
+                if buffer is None:
+                    raise BackupFormatError(f"Unknown record type '{record.get('type')}'")
+
+                buffer.append(record)
+                if len(buffer) >= self.batch_size:
+                    self.flush()
+
+            self.flush()
+            self.link()
+
+        DIRECTORY_CACHE.invalidate_where(lambda key, directory: key[0] == self.encrypted_user_id)
+        SEARCH_CACHE.invalidate(self.encrypted_user_id)
+        return self.summary()
+
+    def flush(self):
+        """ Write all of buffered records. Contents are written before directories and directories before files,
+            so stored ids of records, that a file refers to, are always known
+        """
+        try:
+            self.insert_contents(self.buffers['content'])
+            self.insert_directories(self.buffers['directory'])
+            self.insert_files(self.buffers['file'])
+        except (KeyError, TypeError, ValidationError) as error:
+            raise BackupFormatError(f'Malformed record: {error!r}')
+
+        for buffer in self.buffers.values():
+            buffer.clear()
+        self.renew_lease()
+
+        now = time.monotonic()
+        if self.progress and now - self.reported >= self.progress_interval:
+            self.reported = now
+            self.progress(self.summary())
+
+    def insert_contents(self, records: list):
+        now = datetime.utcnow()
+        # contents are written as raw documents with the same fields as Content.register() upserts
+        documents = [
+            {
+                'user_id': self.encrypted_user_id,
+                'digest': record['digest'],
+                'media_type': record.get('media_type'),
+                'mime_type': record.get('mime_type'),
+                'size': record.get('size') or 0,
+                'references': 0,
+                'created': record.get('created') or now,
+                'updated': now,
+            }
+            for record in records
+        ]
+        skipped = _insert_unordered(Content._get_collection(), documents)
+        stored = {}
+        if skipped:
+            stored = {
+                content['digest']: content['_id']
+                for content in Content._get_collection().find(
+                    {'user_id': self.encrypted_user_id, 'digest': {'$in': [documents[i]['digest'] for i in skipped]}},
+                    {'digest': 1}
+                )
+            }
+
+        for index, (record, document) in enumerate(zip(records, documents)):
+            self.contents[record['id']] = stored[document['digest']] if index in skipped else document['_id']
+        self.counts['content'] += len(records) - len(skipped)
+        self.counts['skipped'] += len(skipped)
+
+    def insert_directories(self, records: list):
+        directories = []
+        for record in records:
+            parent_path = self.paths.get(record['parent']) if record.get('parent') else None
+            if not Directory.is_valid_name(record['name']) or \
+                    record['path'] != Directory.build_path(parent_path, record['name']) or \
+                    (record.get('parent') and parent_path is None):
+                raise BackupFormatError(f"Directory '{record['path']}' doesn't follow its parent")
+            # the only directory without parent is the root one, other trees couldn't be reached from it
+            if not record.get('parent') and record['name'] != ROOT_DIRECTORY:
+                raise BackupFormatError(f"Directory '{record['path']}' has no parent")
+            self.paths[record['id']] = record['path']
+
+            directories.append(Directory(
+                id=ObjectId(),
+                name=record['name'],
+                user_id=self.encrypted_user_id,
+                path=record['path'],
+                created=record.get('created'),
+                updated=record.get('updated'),
+            ))
+
+        # bulk insert doesn't fire signals, clean and validate documents
+        signals.pre_bulk_insert.send(Directory, documents=directories)
+        for directory in directories:
+            directory.validate()
+        skipped = _insert_unordered(Directory._get_collection(), [directory.to_mongo() for directory in directories])
+
+        stored = {}
+        if skipped:
+            stored = {
+                directory['path']: directory
+                for directory in Directory._get_collection().find(
+                    {
+                        'user_id': Binary(self.encrypted_user_id),
+                        'path': {'$in': [directories[i].path for i in skipped]}
+                    },
+                    {'path': 1}
+                )
+            }
+
+        for index, (record, directory) in enumerate(zip(records, directories)):
+            if index in skipped:
+                self.directories[record['id']] = stored[directory.path]['_id']
+            else:
+                self.directories[record['id']] = directory.id
+            self.parents.append((self.directories[record['id']], record.get('parent')))
+        self.counts['directory'] += len(records) - len(skipped)
+        self.counts['skipped'] += len(skipped)
+
+    def insert_files(self, records: list):
+        for record in records:
+            if record['directory'] not in self.directories:
+                raise BackupFormatError(f"File {record['id']} doesn't follow its directory")
+            record['lookup_digest'] = File.build_lookup_digest(self.user_id, record['message_id'])
+
+        # files, that are already stored, don't take positions
+        stored = set(File._get_collection().find(
+            {'lookup_digest': {'$in': [record['lookup_digest'] for record in records]}}
+        ).distinct('lookup_digest')) if records else set()
+        records = [record for record in records if record['lookup_digest'] not in stored]
+        self.counts['skipped'] += len(stored)
+
+        # positions are reserved like by Directory.attach_files(), files keep their exported order
+        amounts = Counter(self.directories[record['directory']] for record in records)
+        positions = {}
+        for directory_id, amount in amounts.items():
+            directory = Directory._get_collection().find_one_and_update(
+                {'_id': directory_id},
+                {'$inc': {'last_file_position': amount}},
+                projection={'last_file_position': 1},
+                return_document=ReturnDocument.AFTER
+            )
+            positions[directory_id] = directory['last_file_position'] - amount
+
+        files = []
+        for record in records:
+            directory_id = self.directories[record['directory']]
+            positions[directory_id] += 1
+            files.append(File(
+                telegram_id=record['message_id'],
+                lookup_digest=record['lookup_digest'],
+                file_id=record.get('file_id'),
+                media_type=record.get('media_type'),
+                content=self.contents.get(record.get('content')),
+                name=record.get('name'),
+                user_id=self.encrypted_user_id,
+                directory=directory_id,
+                position=positions[directory_id],
+                created=record.get('created'),
+                updated=record.get('updated'),
+            ))
+
+        signals.pre_bulk_insert.send(File, documents=files)
+        for file in files:
+            file.validate()
+        skipped = _insert_unordered(File._get_collection(), [file.to_mongo() for file in files])
+
+        for index, record in enumerate(records):
+            content_id = self.contents.get(record.get('content'))
+            if index not in skipped and content_id is not None:
+                self.references[content_id] += 1
+        self.counts['file'] += len(records) - len(skipped)
+        self.counts['skipped'] += len(skipped)
+
+    def link(self):
+        """ Second bulk pass: set parents of directories, that have none (inserted ones or inserted by interrupted
+            import), and add references of imported files to contents
+        """
+        requests = [
+            UpdateOne({'_id': directory_id, 'parent': None}, {'$set': {'parent': self.directories[parent]}})
+            for directory_id, parent in self.parents if parent is not None
+        ]
+        for start in range(0, len(requests), self.batch_size):
+            Directory._get_collection().bulk_write(requests[start:start + self.batch_size], ordered=False)
+
+        references = list(self.references.items())
+        for start in range(0, len(references), self.batch_size):
+            Content._get_collection().bulk_write([
+                UpdateOne({'_id': content_id}, {'$inc': {'references': amount}})
+                for content_id, amount in references[start:start + self.batch_size]
+            ], ordered=False)
+
+    def summary(self) -> dict:
+        """ Counts of imported and skipped records with throughput of import
+        """
+        seconds = time.monotonic() - self.started
+        imported = self.counts['content'] + self.counts['directory'] + self.counts['file']
+        return {
+            **self.counts,
+            'seconds': round(seconds, 3),
+            'records_per_second': round((imported + self.counts['skipped']) / seconds, 1) if seconds else None,
+        }
+
+
+def import_tree(stream, user_id: int = None, batch_size: int = EXPORT_BATCH_SIZE, progress=None) -> dict:
+    """ Import export from binary stream into directory tree of user (see TreeImport)
+
+    :param stream: binary file-like object with export, gzipped or not
+    :param user_id: telegram id of user, the user of export is taken by default
+    :param batch_size: amount of records, written by one bulk insert
+    :param progress: callback, that gets counts of imported records during import
+    :return: counts of imported and skipped records by type, duration and throughput
+    :raises BackupFormatError: if stream is not a valid export
+    :raises LeaseBusyError: if the tree of user is changed by another worker
+    """
+    records = read_records(stream)
+    manifest = next(records)
+    if user_id is None:
+        user_id = manifest.get('user_id')
+    if not isinstance(user_id, int):
+        raise BackupFormatError('User of export is unknown')
+
+    return TreeImport(user_id, batch_size, progress).run(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export and import directory trees of users')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help='Export directory tree of user to newline-delimited JSON')
+    export.add_argument('user_id', type=int, help='Telegram id of user')
+    export.add_argument('--output', default='-', help='Path of export file, "-" for stdout')
+    export.add_argument('--gzip', action='store_true', help='Compress export with gzip')
+    export.add_argument('--batch-size', type=int, default=EXPORT_BATCH_SIZE)
+    restore = commands.add_parser('import', help='Import directory tree of user from newline-delimited JSON')
+    restore.add_argument('input', help='Path of export file, gzipped or not, "-" for stdin')
+    restore.add_argument('--user-id', type=int, help='Telegram id of user, the user of export by default')
+    restore.add_argument('--batch-size', type=int, default=EXPORT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        def __progress(counts):
+            print(f'Imported: {counts}', file=sys.stderr)
+
+        try:
+            if args.input == '-':
+                counts = import_tree(sys.stdin.buffer, args.user_id, args.batch_size, __progress)
+            else:
+                with open(args.input, 'rb') as archive:
+                    counts = import_tree(archive, args.user_id, args.batch_size, __progress)
+        except (BackupFormatError, LeaseBusyError) as error:
+            parser.exit(1, f'Import of {args.input} is failed: {error}\n')
+
+        logger.info(f'Import of {args.input} is finished: {counts}')
+        print(f'Import of {args.input} is finished: {counts}', file=sys.stderr)
+        return
+
+    if args.output == '-':
+        counts = write_export(args.user_id, sys.stdout.buffer, args.gzip, args.batch_size)
+    else:
+        with open(args.output, 'wb') as output:
+            counts = write_export(args.user_id, output, args.gzip, args.batch_size)
+
+    logger.info(f'Export of user {args.user_id} is finished: {counts}')
+    print(f'Export of user {args.user_id} is finished: {counts}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import time
+from threading import RLock
+from collections import OrderedDict
+
+
+class LRUCache:
+    """ Thread-safe bounded LRU cache with optional time-to-live of stored items. Besides amount of items, cache
+        could be bounded by total weight of items, e.g. amount of entries in cached collections
+    """
+    def __init__(self, max_size: int, ttl: float = None, max_weight: int = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.version = 0
+        self._items = OrderedDict()
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """ Get cached value by key
+
+        :param key: key of cached value
+        :return: cached value or None, if there is no fresh value for given key
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                value, expires, _ = item
+                if expires is None or expires > time.monotonic():
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self.__remove(key)
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value, version: int = None, weight: int = 1):
+        """ Store value in cache and evict the least recently used items if cache is full
+
+        :param key: key of cached value
+        :param value: value to cache
+        :param version: cache version, read before value was loaded. If any invalidation happened since then,
+            value could be stale and is not stored
+        :param weight: weight of value, that is counted against max_weight
+        """
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+
+            expires = time.monotonic() + self.ttl if self.ttl else None
+            self.__remove(key)
+            self._items[key] = (value, expires, weight)
+            self.weight += weight
+            self.__evict()
+
+    def update(self, key, function) -> bool:
+        """ Change cached value in place instead of removing it. Cache version is changed as by invalidation, so
+            values, that were loaded before the change, are not stored
+
+        :param key: key of cached value
+        :param function: callable, that takes cached value, changes it and returns its new weight
+        :return: True if value was cached and changed, otherwise False
+        """
+        with self._lock:
+            self.version += 1
+            item = self._items.get(key)
+            if item is None:
+                return False
+
+            value, expires, weight = item
+            new_weight = function(value)
+            self._items[key] = (value, expires, new_weight)
+            self.weight += new_weight - weight
+            self.__evict()
+            return True
+
+    def invalidate(self, key):
+        """ Remove cached value by key
+        """
+        with self._lock:
+            self.version += 1
+            self.__remove(key)
+
+    def invalidate_where(self, predicate) -> int:
+        """ Remove all cached values, that match given predicate
+
+        :param predicate: callable, that takes key and value and returns True for items to remove
+        :return: amount of removed items
+        """
+        with self._lock:
+            self.version += 1
+            stale = [key for key, (value, _, _) in self._items.items() if predicate(key, value)]
+            for key in stale:
+                self.__remove(key)
+
+            return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._items.clear()
+            self.weight = 0
+
+    def stats(self) -> dict:
+        """ Get cache usage counters
+
+        :return: size, hits, misses, evictions and hit ratio of the cache
+        """
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'size': len(self._items),
+                'max_size': self.max_size,
+                'weight': self.weight,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / requests, 4) if requests else 0.0,
+            }
+
+    def __remove(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.weight -= item[2]
+
+    def __evict(self):
+        """ Remove the least recently used items, while cache has too many items or they are too heavy
+        """
+        while self._items and (
+            len(self._items) > self.max_size or (self.max_weight is not None and self.weight > self.max_weight)
+        ):
+            _, (_, _, weight) = self._items.popitem(last=False)
+            self.weight -= weight
+            self.evictions += 1
@@ -0,0 +1,65 @@
+import hmac
+import base64
+import hashlib
+import binascii
+from bson import ObjectId
+from app.config import CRYPTO, CALLBACK_DIGEST_SIZE
+
+SEPARATOR = '.'
+ID_SIZE = 12
+# optional unsigned number after ids, e.g. upload position of file
+NUMBER_SIZE = 8
+
+
+def _digest(action: str, user_id: int, payload: bytes) -> bytes:
+    message = f'{user_id}:{action}:'.encode() + payload
+    return hmac.new(CRYPTO.callback_key, message, hashlib.sha256).digest()[:CALLBACK_DIGEST_SIZE]
+
+
+def sign(action: str, user_id: int, *ids, number: int = None) -> str:
+    """ Build callback data of inline keyboard button. Telegram limits callback data to 64 bytes, so instead of
+        names it carries binary ObjectIds and truncated HMAC, that binds them to the action and the user, who
+        gets the keyboard
+
+    :param action: short code of action (see DIRECTORY_ACTIONS)
+    :param user_id: id of user, who gets the keyboard
+    :param ids: ObjectIds of documents, that the button refers to
+    :param number: not negative number, that the button refers to, e.g. position of file
+    :return: callback data, e.g. 'g.<URL-safe base64 of ids, number and digest>'
+    """
+    payload = b''.join(ObjectId(value).binary for value in ids)
+    if number is not None:
+        payload += number.to_bytes(NUMBER_SIZE, 'big')
+    body = base64.urlsafe_b64encode(payload + _digest(action, user_id, payload)).rstrip(b'=').decode()
+
+    return f'{action}{SEPARATOR}{body}'
+
+
+def verify(data: str, user_id: int):
+    """ Check signature of callback data, built by sign()
+
+    :param data: callback data of pressed button
+    :param user_id: id of user, who pressed the button
+    :return: action, list of ObjectIds and number (None, if it isn't signed) or None, if data is malformed or
+             isn't signed for the user
+    """
+    action, separator, body = data.partition(SEPARATOR)
+    if not separator:
+        return None
+
+    try:
+        raw = base64.urlsafe_b64decode(body + '=' * (-len(body) % 4))
+    except (binascii.Error, ValueError):
+        return None
+
+    payload, digest = raw[:-CALLBACK_DIGEST_SIZE], raw[-CALLBACK_DIGEST_SIZE:]
+    if len(raw) < CALLBACK_DIGEST_SIZE or len(payload) % ID_SIZE not in (0, NUMBER_SIZE):
+        return None
+    if not hmac.compare_digest(digest, _digest(action, user_id, payload)):
+        return None
+
+    number = None
+    if len(payload) % ID_SIZE:
+        payload, number = payload[:-NUMBER_SIZE], int.from_bytes(payload[-NUMBER_SIZE:], 'big')
+
+    return action, [ObjectId(payload[start:start + ID_SIZE]) for start in range(0, len(payload), ID_SIZE)], number
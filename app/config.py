@@ -1,21 +1,36 @@
 import os
+import hmac
 import base64
+import hashlib
 import pathlib
+from threading import Lock
 from json_log_formatter import JSONFormatter
 from mongoengine import register_connection
-from cryptography.fernet import Fernet
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from app.errors import StartUpError
 
+
+def env_flag(name: str, default: bool) -> bool:
+    """ Read boolean flag from environment variable
+
+    :param name: name of environment variable
+    :param default: value, used if variable is not set
+    :return: True for '1', 'true', 'yes' and 'on' values, otherwise False
+    """
+    value = os.getenv(name)
+    if value is None:
+        return default
+
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
 ###################################################################################################
 # Server settings
 ###################################################################################################
 APP_DIR = pathlib.Path(
     os.path.abspath(os.path.dirname(__file__))
 )
-DEBUG_MODE = os.getenv('DEBUG_MODE', True)
+DEBUG_MODE = env_flag('DEBUG_MODE', False)
+STATS_LOG_INTERVAL = int(os.getenv('STATS_LOG_INTERVAL', 600))
 
 ###################################################################################################
 # Logging
@@ -28,9 +43,14 @@ APP_LOG_FORMAT = (
 )
 APP_LOG_DIR = os.getenv('APP_LOG_DIR', f'{APP_DIR}/logs/')
 APP_LOG_PATH = f'{APP_LOG_DIR}telegram_cloud.log'
-APP_LOG_FILE_ROTATION_SIZE = int(os.getenv('APP_LOG_FILE_ROTATION_SIZE', 100000))
+APP_LOG_FILE_ROTATION_SIZE = int(os.getenv('APP_LOG_FILE_ROTATION_SIZE', 10 * 2 ** 20))
 APP_LOG_FILE_BACKUP_COUNT = int(os.getenv('APP_LOG_FILE_BACKUP_COUNT', 14))
 APP_LOG_LEVEL = os.getenv('APP_LOG_LEVEL', 'WARNING') if not DEBUG_MODE else 'DEBUG'
+# records are written by background thread from bounded queue, records are dropped, when the queue is full
+APP_LOG_QUEUE_ENABLED = env_flag('APP_LOG_QUEUE_ENABLED', True)
+APP_LOG_QUEUE_SIZE = int(os.getenv('APP_LOG_QUEUE_SIZE', 10000))
+# share of DEBUG and INFO records to keep
+APP_LOG_SAMPLE_RATE = float(os.getenv('APP_LOG_SAMPLE_RATE', 1.0))
 if not os.path.exists(APP_LOG_DIR):
     os.makedirs(APP_LOG_DIR)
 
@@ -88,13 +108,58 @@ LOGGING_CONFIG = {
 ###################################################################################################
 TOKEN = os.getenv('TOKEN', None)
 ROOT_DIRECTORY = os.getenv('ROOT_DIRECTORY', 'ROOT')
+# separator of directory names in paths, e.g. ROOT/photos/2024
+PATH_SEPARATOR = '/'
 SECRET_KEY = os.getenv('SECRET_KEY', None)
 SALT = os.getenv('SALT', None)
 CANCEL_BUTTON = 'Cancel'
+# codes of directory keyboard actions in signed callback data (see app.callbacks), page buttons are coded by
+# direction and action of the keyboard, e.g. 'ng' is the next page of /goto keyboard
 DIRECTORY_ACTIONS = {
-    'goto': 'goto',
-    'delete': 'delete'
+    'goto': 'g',
+    'delete': 'd',
+    'cancel': 'c',
+    'next': 'n',
+    'previous': 'p',
 }
+# bytes of HMAC, kept in callback data
+CALLBACK_DIGEST_SIZE = 8
+DIRECTORY_PAGE_SIZE = int(os.getenv('DIRECTORY_PAGE_SIZE', 20))
+# codes of media keyboard actions in signed callback data
+MEDIA_ACTIONS = {
+    'show': 's'
+}
+NEXT_PAGE_BUTTON = 'Next page'
+PREVIOUS_PAGE_BUTTON = 'Previous page'
+SHOW_PAGE_SIZE = int(os.getenv('SHOW_PAGE_SIZE', 30))
+MEDIA_GROUP_SIZE = 10
+SEARCH_ACTIONS = {
+    'page': 'find',
+    'jump': 'jump',
+}
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 10))
+# bytes of /find prefix, that is kept in callback data of page buttons, limited by Telegram to 64 bytes
+SEARCH_PREFIX_MAX_SIZE = 48
+MEDIA_TYPES = ('photo', 'video', 'document', 'audio', 'voice')
+# media types, that could be sent together in one album
+ALBUM_MEDIA_TYPES = ('photo', 'video')
+BULK_DELETE_BATCH_SIZE = int(os.getenv('BULK_DELETE_BATCH_SIZE', 1000))
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+# Bot API limit of document size, that bot could send
+EXPORT_MAX_SIZE = int(os.getenv('EXPORT_MAX_SIZE', 50 * 2 ** 20))
+# Bot API limit of document size, that bot could download
+IMPORT_MAX_SIZE = int(os.getenv('IMPORT_MAX_SIZE', 20 * 2 ** 20))
+# seconds between progress reports of import
+IMPORT_PROGRESS_INTERVAL = float(os.getenv('IMPORT_PROGRESS_INTERVAL', 5))
+# seconds to wait for the rest of photos of an album before it is saved
+ALBUM_WINDOW = float(os.getenv('ALBUM_WINDOW', 1.0))
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', 30))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', 1))
+SEND_CHAT_BURST = int(os.getenv('SEND_CHAT_BURST', 3))
+SEND_CONCURRENCY = int(os.getenv('SEND_CONCURRENCY', 8))
+SEND_MERGE_MESSAGES = env_flag('SEND_MERGE_MESSAGES', True)
+PERSISTENCE_ENABLED = env_flag('PERSISTENCE_ENABLED', True)
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv('PERSISTENCE_FLUSH_INTERVAL', 5))
 if not TOKEN:
     raise StartUpError("TOKEN is requires environment variable")
 
@@ -104,6 +169,33 @@ if not SECRET_KEY:
 if not SALT:
     raise StartUpError("SALT is requires environment variable")
 
+###################################################################################################
+# Serving settings
+###################################################################################################
+UPDATE_MODES = ('polling', 'webhook')
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling')
+WORKERS = int(os.getenv('WORKERS', 8))
+# amount of worker processes, updates are sharded to by user id. 1 serves updates in the main process
+SHARDS = int(os.getenv('SHARDS', 1))
+SHARD_QUEUE_SIZE = int(os.getenv('SHARD_QUEUE_SIZE', 10000))
+# seconds a lease of user directory tree is held before it expires and seconds to wait for a busy one
+LEASE_TTL = float(os.getenv('LEASE_TTL', 30))
+LEASE_WAIT = float(os.getenv('LEASE_WAIT', 5))
+CONNECTION_POOL_SIZE = int(os.getenv('CONNECTION_POOL_SIZE', SEND_CONCURRENCY + 4))
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', None)
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_URL_PATH = os.getenv('WEBHOOK_URL_PATH', TOKEN)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', None)
+if UPDATE_MODE not in UPDATE_MODES:
+    raise StartUpError(f"UPDATE_MODE should be one of: {', '.join(UPDATE_MODES)}")
+
+if UPDATE_MODE == 'webhook' and not WEBHOOK_URL:
+    raise StartUpError("WEBHOOK_URL is required in webhook UPDATE_MODE")
+
+if SHARDS < 1:
+    raise StartUpError("SHARDS should be a positive number")
+
 ###################################################################################################
 # NoSQL DB settings
 ###################################################################################################
@@ -112,8 +204,13 @@ MONGO_PASSWORD = os.getenv('MONGO_PASSWORD', None)
 MONGO_HOST = os.getenv('MONGO_HOST', None)
 MONGO_PORT = os.getenv('MONGO_PORT', None)
 MONGO_DB_NAME = os.getenv('MONGO_DB_NAME', None)
-MONGO_CONNECTION_URL = f'mongodb://{MONGO_USER}:{MONGO_PASSWORD}@{MONGO_HOST}:{MONGO_PORT}/{MONGO_DB_NAME}'
+# full connection URL overrides the one, built from parts, e.g. 'mongomock://localhost/<db name>' for benchmarks
+MONGO_CONNECTION_URL = os.getenv(
+    'MONGO_CONNECTION_URL',
+    f'mongodb://{MONGO_USER}:{MONGO_PASSWORD}@{MONGO_HOST}:{MONGO_PORT}/{MONGO_DB_NAME}'
+)
 MONGO_ENGINE_ALIAS = 'core'
+MONGO_POOL_SIZE = int(os.getenv('MONGO_POOL_SIZE', 100))
 if not MONGO_USER:
     raise StartUpError("MONGO_USER is requires environment variable")
 
@@ -129,20 +226,158 @@ if not MONGO_PORT:
 if not MONGO_DB_NAME:
     raise StartUpError("MONGO_DB_NAME is requires environment variable")
 
-register_connection(alias=MONGO_ENGINE_ALIAS, host=MONGO_CONNECTION_URL)
+DATABASE_EVENT_LISTENERS = []
+__database_lock = Lock()
+__database_registered = False
+
+
+def register_database():
+    """ Register MongoDB connection on the first use instead of import time. Connection is registered once, with
+        pymongo event listeners, added to DATABASE_EVENT_LISTENERS before that
+    """
+    global __database_registered
+    if __database_registered:
+        return
+
+    with __database_lock:
+        if not __database_registered:
+            register_connection(
+                alias=MONGO_ENGINE_ALIAS,
+                host=MONGO_CONNECTION_URL,
+                maxPoolSize=MONGO_POOL_SIZE,
+                event_listeners=list(DATABASE_EVENT_LISTENERS)
+            )
+            __database_registered = True
+
+###################################################################################################
+# Metrics settings
+###################################################################################################
+METRICS_PREFIX = 'telegram_cloud'
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# port of Prometheus metrics endpoint, 0 disables it
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# bucket bounds of histograms of DB queries and Bot API calls per update
+METRICS_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50)
+# updates, handled longer than the threshold in seconds, are logged with their query and call counters, 0 disables it
+SLOW_UPDATE_THRESHOLD = float(os.getenv('SLOW_UPDATE_THRESHOLD', 0))
+
+###################################################################################################
+# Cache settings
+###################################################################################################
+DIRECTORY_CACHE_SIZE = int(os.getenv('DIRECTORY_CACHE_SIZE', 10000))
+DIRECTORY_CACHE_TTL = int(os.getenv('DIRECTORY_CACHE_TTL', 300))
+DECRYPT_CACHE_SIZE = int(os.getenv('DECRYPT_CACHE_SIZE', 50000))
+# max amount of users, whose search indexes are kept in memory, and total amount of names in these indexes
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', 1000))
+SEARCH_CACHE_MAX_NAMES = int(os.getenv('SEARCH_CACHE_MAX_NAMES', 100000))
+# users with more searchable names are searched in MongoDB only, that is rechecked in SEARCH_LARGE_USER_TTL seconds
+SEARCH_INDEX_MAX_SIZE = int(os.getenv('SEARCH_INDEX_MAX_SIZE', 20000))
+SEARCH_LARGE_USER_TTL = int(os.getenv('SEARCH_LARGE_USER_TTL', 3600))
+# search index of user is built on the search, that is made in SEARCH_HOT_WINDOW seconds after the previous one
+SEARCH_HOT_WINDOW = int(os.getenv('SEARCH_HOT_WINDOW', 600))
 
 ###################################################################################################
 # Cryptography settings
 ###################################################################################################
-__password = SECRET_KEY.encode()
-__salt = SALT.encode()
-__kdf = PBKDF2HMAC(
-    algorithm=hashes.SHA256(),
-    length=32,
-    salt=__salt,
-    iterations=100000,
-    backend=default_backend()
-)
-__key = base64.urlsafe_b64encode(__kdf.derive(__password))
+CRYPTO_KEY = os.getenv('CRYPTO_KEY', None)
+CRYPTO_KEY_FILE = os.getenv('CRYPTO_KEY_FILE', None)
+KDF_ITERATIONS = 100000
+
+
+class LazyCrypto:
+    """ Fernet encryption, which key is derived from SECRET_KEY and SALT on the first use instead of import time.
+        Derived key could be provided with CRYPTO_KEY environment variable or cached in CRYPTO_KEY_FILE to skip
+        PBKDF2 on start up. Cached key is bound to fingerprint of SECRET_KEY and SALT and is derived again, when they
+        change
+    """
+    def __init__(self):
+        self._key = None
+        self._lookup_key = None
+        self._callback_key = None
+        self._fernet = None
+        self._lock = Lock()
+
+    @property
+    def key(self) -> bytes:
+        if self._key is None:
+            with self._lock:
+                if self._key is None:
+                    self._key = self.__load_key()
+
+        return self._key
+
+    @property
+    def lookup_key(self) -> bytes:
+        """ Key of deterministic lookup digests
+        """
+        if self._lookup_key is None:
+            self._lookup_key = hmac.new(self.key, b'telegram_cloud.lookup', hashlib.sha256).digest()
+
+        return self._lookup_key
+
+    @property
+    def callback_key(self) -> bytes:
+        """ Key of callback data signatures
+        """
+        if self._callback_key is None:
+            self._callback_key = hmac.new(self.key, b'telegram_cloud.callback', hashlib.sha256).digest()
+
+        return self._callback_key
+
+    @property
+    def fernet(self):
+        if self._fernet is None:
+            from cryptography.fernet import Fernet
+            self._fernet = Fernet(self.key)
+
+        return self._fernet
+
+    def encrypt(self, data: bytes) -> bytes:
+        return self.fernet.encrypt(data)
+
+    def decrypt(self, token: bytes, ttl: int = None) -> bytes:
+        return self.fernet.decrypt(token, ttl)
+
+    @staticmethod
+    def derive_key() -> bytes:
+        """ Derive encryption key from SECRET_KEY and SALT with PBKDF2
+        """
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+        kdf = PBKDF2HMAC(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=SALT.encode(),
+            iterations=KDF_ITERATIONS,
+            backend=default_backend()
+        )
+        return base64.urlsafe_b64encode(kdf.derive(SECRET_KEY.encode()))
+
+    @staticmethod
+    def __fingerprint() -> str:
+        return hashlib.sha256(f'{KDF_ITERATIONS}:{SALT}:{SECRET_KEY}'.encode()).hexdigest()
+
+    def __load_key(self) -> bytes:
+        if CRYPTO_KEY:
+            return CRYPTO_KEY.encode()
+
+        fingerprint = self.__fingerprint()
+        if CRYPTO_KEY_FILE and os.path.exists(CRYPTO_KEY_FILE):
+            with open(CRYPTO_KEY_FILE) as key_file:
+                cached_fingerprint, _, key = key_file.read().strip().partition(' ')
+            if cached_fingerprint == fingerprint and key:
+                return key.encode()
+
+        key = self.derive_key()
+        if CRYPTO_KEY_FILE:
+            descriptor = os.open(CRYPTO_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(descriptor, 'w') as key_file:
+                key_file.write(f'{fingerprint} {key.decode()}')
+
+        return key
+
 
-CRYPTO = Fernet(__key)
+CRYPTO = LazyCrypto()
@@ -1,2 +1,10 @@
 class StartUpError(Exception):
     pass
+
+
+class LeaseBusyError(Exception):
+    pass
+
+
+class BackupFormatError(Exception):
+    pass
@@ -1,15 +1,34 @@
-from app import logger
-from app.models import File, Directory
-from app.config import ROOT_DIRECTORY, CANCEL_BUTTON, DIRECTORY_ACTIONS
-from telegram.error import BadRequest
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from functools import reduce
+import time
+import tempfile
+from datetime import datetime
+from functools import reduce, wraps
+from app import logger, log_queue
+from app import search, callbacks, backup
+from app.metrics import METRICS, begin_trace, end_trace
+from app.models import File, Directory, Content, DIRECTORY_CACHE
+from app.albums import ALBUM_BUFFER, AlbumReady
+from app.sender import resolved, ignore_bad_request
+from app.errors import LeaseBusyError, BackupFormatError
+from app.config import (ROOT_DIRECTORY, CANCEL_BUTTON, DIRECTORY_ACTIONS, MEDIA_ACTIONS, NEXT_PAGE_BUTTON,
+                        PREVIOUS_PAGE_BUTTON, SHOW_PAGE_SIZE, MEDIA_GROUP_SIZE, ALBUM_WINDOW, MEDIA_TYPES,
+                        ALBUM_MEDIA_TYPES, SEARCH_ACTIONS, SEARCH_PAGE_SIZE, SLOW_UPDATE_THRESHOLD, PATH_SEPARATOR,
+                        DIRECTORY_PAGE_SIZE, EXPORT_MAX_SIZE, IMPORT_MAX_SIZE, SEARCH_PREFIX_MAX_SIZE,
+                        METRICS_COUNT_BUCKETS)
+from bson import ObjectId
+from mongoengine.errors import DoesNotExist, NotUniqueError
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputMediaVideo
+from collections import Counter
+
+INPUT_MEDIA = {'photo': InputMediaPhoto, 'video': InputMediaVideo}
+TREE_BUSY_MESSAGE = 'Your directories are being changed right now, please try again in a moment'
+EXPIRED_KEYBOARD_MESSAGE = 'This keyboard is expired, please request it again'
 
 
 class PreProcessors:
     @staticmethod
     def validate_args(amount_of_args):
         def decorator(function):
+            @wraps(function)
             def apply(update, context):
                 if len(context.args) == amount_of_args:
                     return function(
@@ -26,30 +45,65 @@ class PreProcessors:
 
     @staticmethod
     def set_root_directory(function):
-        """ Set up ROOT_DIRECTORY, if chat_data doesn't contain one
+        """ Set up ROOT_DIRECTORY, if chat_data doesn't contain path of current directory
         """
+        @wraps(function)
         def decorator(update, context, *args, **kwargs):
             current_directory = context.chat_data.get('current_directory')
-            if not current_directory:
+            # chat data, stored before paths were introduced, contains name of current directory
+            if not current_directory or not (
+                current_directory == ROOT_DIRECTORY or current_directory.startswith(ROOT_DIRECTORY + PATH_SEPARATOR)
+            ):
                 context.chat_data['current_directory'] = ROOT_DIRECTORY
             function(update, context, *args, **kwargs)
         return decorator
 
+    @staticmethod
+    def instrument(function):
+        """ Record handler latency, amount of DB queries and Bot API calls per update to METRICS. Updates, that are
+            handled longer than SLOW_UPDATE_THRESHOLD, are logged with these counters
+        """
+        name = function.__qualname__
+
+        @wraps(function)
+        def decorator(update, context, *args, **kwargs):
+            begin_trace()
+            started = time.perf_counter()
+            status = 'ok'
+            try:
+                return function(update, context, *args, **kwargs)
+            except Exception:
+                status = 'error'
+                raise
+            finally:
+                duration = time.perf_counter() - started
+                trace = end_trace()
+                METRICS.observe('handler_seconds', {'handler': name, 'status': status}, duration)
+                METRICS.observe(
+                    'handler_mongo_queries', {'handler': name}, trace['mongo_queries'], METRICS_COUNT_BUCKETS
+                )
+                METRICS.observe(
+                    'handler_telegram_calls', {'handler': name}, trace['telegram_calls'], METRICS_COUNT_BUCKETS
+                )
+                if SLOW_UPDATE_THRESHOLD and duration >= SLOW_UPDATE_THRESHOLD:
+                    logger.warning(
+                        f'Slow update {getattr(update, "update_id", None)} in {name}: {duration:.3f}s, {trace}'
+                    )
+        return decorator
+
 
 class BaseHandlers:
     @staticmethod
     def error(update, context):
         """ Log Errors caused by Updates.
         """
+        METRICS.inc('handler_errors_total', {'error': type(context.error).__name__})
         logger.warning(f'{context.error}')
 
     @staticmethod
     def start(update, context):
         logger.info('New user joined')
-        root_directory = Directory.objects.get(
-            name=ROOT_DIRECTORY,
-            user_id=Directory.encrypt_user_id(update.effective_user.id)
-        )
+        root_directory = Directory.get_by_path(ROOT_DIRECTORY, Directory.encrypt_user_id(update.effective_user.id))
         if root_directory:
             pass
         else:
@@ -70,41 +124,125 @@ class BaseHandlers:
             '/current - Display the name of current directory;\n'
             '/dirs - Display subdirectories of the current directory;\n'
             '/goto - Display list of subdirectories, located in the current directory, to be redirected to;\n'
+            '/goto <Path> - Redirect user to directory by its path, e.g. "a/b", "../c" or "/a" from the root one;\n'
             '/back - Redirect user to parent directory of the current one;\n'
-            '/show - Display files, stored in the current directory.'
+            '/move <Path> <Destination path> - Move directory with its content to another one;\n'
+            '/rename <Path> <New name> - Rename directory;\n'
+            '/show - Display files, stored in the current directory, page by page;\n'
+            '/stats - Display amount of stored files and size, saved by deduplication of repeated uploads;\n'
+            '/find <Prefix> - Find directories and files, whose name or caption starts with the prefix;\n'
+            '/export - Send all your directories and files as a gzipped newline-delimited JSON document;\n'
+            '/import - Restore directories and files from export, send it as a reply to the export document.'
         )
 
+    @staticmethod
+    def resume_pending_moves(context):
+        """ Finish directory moves, that were interrupted by restart
+        """
+        moved = Directory.resume_pending_moves()
+        if moved:
+            logger.info(f'Interrupted directory moves are finished: {moved} subdirectories are moved')
+
+    @staticmethod
+    def resume_pending_deletes(context):
+        """ Finish directory deletions, that were interrupted by restart
+        """
+        deleted = Directory.resume_pending_deletes()
+        if deleted['directories'] or deleted['files']:
+            logger.info(f'Interrupted directory deletions are finished: {deleted}')
+
+    @staticmethod
+    def log_stats(context):
+        """ Periodically log usage counters of directory cache and outgoing messages queue to be able to size them
+        """
+        logger.info(f'Directory cache stats: {DIRECTORY_CACHE.stats()}')
+        logger.info(f'Send queue stats: {context.bot.scheduler.stats()}')
+        if log_queue:
+            logger.info(f'Logging queue stats: {log_queue.stats()}')
+        dispatcher = context.job.context
+        if dispatcher.persistence:
+            logger.info(f'Conversation state stats: {dispatcher.persistence.stats()}')
+
 
 class FileSystemHandlers:
     @staticmethod
-    def __create_subdirectories_keyboard(current_directory: object, action: str) -> list:
-        """ NOTE: this method assumes, that <current_directory> contains subdirectories and there is no
+    def __create_subdirectories_keyboard(subdirectories: list, action: str, user_id: int, parent_id,
+                                         navigation: list = None) -> list:
+        """ NOTE: this method assumes, that <subdirectories> is not empty and there is no
             need for additional validation
 
-        :param current_directory: Directory instance
+        :param subdirectories: ids and names of subdirectories (see Directory.get_subdirectories_page())
         :param action: type of action, that should be performed over directory
+        :param user_id: id of user, who gets the keyboard
+        :param parent_id: id of directory, that contains subdirectories
+        :param navigation: buttons of previous and next pages
         :return: list with directories
         """
-        def __reducer(result: list, directory: object):
-            """ Divides array of subdirectories, stored at directory.contains_directories to list of two
-                items lists to have well readable inline keyboard
+        def __reducer(result: list, subdirectory: tuple):
+            """ Divides array of subdirectory names to list of two items lists to have well readable inline keyboard
             Example: [Dir1, Dir2, Dir3, Dir4, Dir5] -> __reducer() -> [[Dir1, Dir2], [Dir3, Dir4], [Dir5]]
 
             :param result: list of two items lists
-            :param directory: Directory instance
+            :param subdirectory: id and name of subdirectory
             :return: [[Dir1, Dir2], [Dir3, Dir4], [Dir5]]
             """
+            directory_id, name = subdirectory
             if len(result[-1]) == 2:
                 result.append([])
-            result[-1].append(InlineKeyboardButton(directory.name, callback_data=f"{action},{directory.name}"))
+            result[-1].append(InlineKeyboardButton(
+                name, callback_data=callbacks.sign(action, user_id, directory_id, parent_id)
+            ))
 
             return result
 
-        keyboard = reduce(__reducer, current_directory.contains_directories, [[]])
-        keyboard.append([InlineKeyboardButton(CANCEL_BUTTON, callback_data=f"{action},{CANCEL_BUTTON}")])
+        keyboard = reduce(__reducer, subdirectories, [[]])
+        if navigation:
+            keyboard.append(navigation)
+        keyboard.append([InlineKeyboardButton(
+            CANCEL_BUTTON, callback_data=callbacks.sign(DIRECTORY_ACTIONS['cancel'], user_id)
+        )])
 
         return keyboard
 
+    @staticmethod
+    def __render_subdirectories_page(parent_id, user_id: int, action: str, after: str = None, before: str = None):
+        """ Build keyboard of one page of subdirectories. Page buttons keep id of the first or the last
+            subdirectory of the page, so the next page is fetched by range query instead of skipping previous ones
+
+        :param parent_id: id of directory, that contains subdirectories
+        :param user_id: id of user, who gets the keyboard
+        :param action: type of action, that should be performed over directory
+        :param after: name of the last subdirectory of previous page, None for the first page
+        :param before: name of the first subdirectory of next page, if the page is requested backwards
+        :return: InlineKeyboardMarkup or None, if there are no subdirectories on the page
+        """
+        # one extra subdirectory is fetched to know, whether there is one more page in the direction of the request
+        subdirectories = Directory.get_subdirectories_page(
+            parent_id, Directory.encrypt_user_id(user_id), after, before, DIRECTORY_PAGE_SIZE + 1
+        )
+        if before is not None:
+            has_previous, has_next = len(subdirectories) > DIRECTORY_PAGE_SIZE, True
+            subdirectories = subdirectories[-DIRECTORY_PAGE_SIZE:]
+        else:
+            has_previous, has_next = after is not None, len(subdirectories) > DIRECTORY_PAGE_SIZE
+            subdirectories = subdirectories[:DIRECTORY_PAGE_SIZE]
+        if not subdirectories:
+            return None
+
+        navigation = []
+        if has_previous:
+            navigation.append(InlineKeyboardButton(PREVIOUS_PAGE_BUTTON, callback_data=callbacks.sign(
+                f"{DIRECTORY_ACTIONS['previous']}{action}", user_id, subdirectories[0][0], parent_id
+            )))
+        if has_next:
+            navigation.append(InlineKeyboardButton(NEXT_PAGE_BUTTON, callback_data=callbacks.sign(
+                f"{DIRECTORY_ACTIONS['next']}{action}", user_id, subdirectories[-1][0], parent_id
+            )))
+
+        return InlineKeyboardMarkup(FileSystemHandlers.__create_subdirectories_keyboard(
+            subdirectories, action, user_id, parent_id, navigation
+        ))
+
     @staticmethod
     @PreProcessors.validate_args(1)
     @PreProcessors.set_root_directory
@@ -116,22 +254,26 @@ class FileSystemHandlers:
         :param name: name of a directory to be created
         """
         name = name[0]
-        # check if directory exists
-        if Directory.exists(name, Directory.encrypt_user_id(update.effective_user.id)):
+        current_directory = context.chat_data.get('current_directory')
+        if not Directory.is_valid_name(name):
+            update.message.reply_text(f"Directory name can't contain '{PATH_SEPARATOR}' or be '.' or '..'")
+            return
+
+        try:
+            new_directory = Directory.create_child(
+                current_directory,
+                name,
+                Directory.encrypt_user_id(update.effective_user.id)
+            )
+        except DoesNotExist:
+            update.message.reply_text(f"Seems, the directory '{current_directory}' is deleted")
+            return
+
+        if new_directory is None:
             update.message.reply_text(f"The directory '{name}' already exists")
         else:
-            # create new directory
-            new_directory = Directory(name=name, user_id=update.effective_user.id)
-            new_directory.save()
-            # add new directory as a sub directory to current_directory
-            current_directory = Directory.objects.get(
-                name=context.chat_data.get('current_directory'),
-                user_id=Directory.encrypt_user_id(update.effective_user.id)
-            )
-            current_directory.update(add_to_set__contains_directories=new_directory)
-            current_directory.save()
             update.message.reply_text(
-                f"The directory '{name}' is successfully created and saved in {current_directory.name} directory"
+                f"The directory '{name}' is successfully created and saved in {current_directory} directory"
             )
 
     @staticmethod
@@ -142,20 +284,18 @@ class FileSystemHandlers:
         :param update: Telegram chat data
         :param context: Telegram chat data
         """
-        current_directory = Directory.objects.get(
-            name=context.chat_data.get('current_directory'),
-            user_id=Directory.encrypt_user_id(update.effective_user.id)
+        current_directory = Directory.get_by_path(
+            context.chat_data.get('current_directory'),
+            Directory.encrypt_user_id(update.effective_user.id)
         )
 
-        if current_directory.contains_directories:
-
-            keyboard = FileSystemHandlers.__create_subdirectories_keyboard(
-                current_directory, DIRECTORY_ACTIONS['delete']
-            )
-
+        keyboard = FileSystemHandlers.__render_subdirectories_page(
+            current_directory.id, update.effective_user.id, DIRECTORY_ACTIONS['delete']
+        )
+        if keyboard:
             update.message.reply_text(
                 'Choose the folder, that you want to delete',
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=keyboard
             )
         else:
             update.message.reply_text(
@@ -170,16 +310,13 @@ class FileSystemHandlers:
         :param update: Telegram chat data
         :param context: Telegram chat data
         """
-        current_directory = Directory.objects.get(
-            name=context.chat_data.get('current_directory'),
-            user_id=Directory.encrypt_user_id(update.effective_user.id)
+        current_directory = Directory.get_by_path(
+            context.chat_data.get('current_directory'),
+            Directory.encrypt_user_id(update.effective_user.id)
         )
-        if current_directory.contains_directories:
-            subdirectories = reduce(
-                lambda res, directory: f"{res} {directory.name}",
-                current_directory.contains_directories,
-                ""
-            )
+        subdirectories = current_directory.get_subdirectory_names()
+        if subdirectories:
+            subdirectories = reduce(lambda res, name: f"{res} {name}", subdirectories, "")
 
             update.message.reply_text(
                 f"Current directory {context.chat_data.get('current_directory')} "
@@ -202,44 +339,133 @@ class FileSystemHandlers:
     @PreProcessors.set_root_directory
     def go_to_directory(update, context):
         """ Create a buttons template. Buttons are names of subdirectories, that current directory contains.
-            By clicking on one of buttons user will be redirected to selected directory
+            By clicking on one of buttons user will be redirected to selected directory. If path is given, user is
+            redirected to directory by path with one query
         """
-        current_directory = Directory.objects.get(
-            name=context.chat_data.get('current_directory'),
-            user_id=Directory.encrypt_user_id(update.effective_user.id)
-        )
-        if current_directory.contains_directories:
-
-            keyboard = FileSystemHandlers.__create_subdirectories_keyboard(
-                current_directory, DIRECTORY_ACTIONS['goto']
-            )
+        if context.args:
+            FileSystemHandlers.__go_to_path(update, context, ' '.join(context.args))
+            return
 
+        current_directory = Directory.get_by_path(
+            context.chat_data.get('current_directory'),
+            Directory.encrypt_user_id(update.effective_user.id)
+        )
+        keyboard = FileSystemHandlers.__render_subdirectories_page(
+            current_directory.id, update.effective_user.id, DIRECTORY_ACTIONS['goto']
+        )
+        if keyboard:
             update.message.reply_text(
                 'Choose the folder, that you want go to',
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=keyboard
             )
         else:
             update.message.reply_text(
                 f"There are no subdirectories in the directory {context.chat_data.get('current_directory')}"
             )
 
+    @staticmethod
+    def __go_to_path(update, context, target: str):
+        """ Redirect user to directory by path, that is absolute or relative to the current directory
+
+        :param target: path, given by user
+        """
+        path = Directory.resolve_path(context.chat_data.get('current_directory'), target)
+        directory = Directory.get_by_path(path, Directory.encrypt_user_id(update.effective_user.id)) if path else None
+        if directory:
+            context.chat_data['current_directory'] = directory.path
+            update.message.reply_text(f"You now switched to directory {directory.path}")
+        else:
+            update.message.reply_text(f"There is no directory '{target}'")
+
+    @staticmethod
+    @PreProcessors.validate_args(2)
+    @PreProcessors.set_root_directory
+    def move_directory(update, context, args):
+        """ Move directory with all its subdirectories and files to another one
+
+        :param args: path of directory and path of destination directory
+        """
+        source, destination = args
+        current_path = context.chat_data.get('current_directory')
+        FileSystemHandlers.__relocate(
+            update,
+            context,
+            Directory.resolve_path(current_path, source),
+            Directory.resolve_path(current_path, destination),
+            None
+        )
+
+    @staticmethod
+    @PreProcessors.validate_args(2)
+    @PreProcessors.set_root_directory
+    def rename_directory(update, context, args):
+        """ Rename directory, keeping its position in the tree
+
+        :param args: path of directory and its new name
+        """
+        source, name = args
+        if not Directory.is_valid_name(name):
+            update.message.reply_text(f"Directory name can't contain '{PATH_SEPARATOR}' or be '.' or '..'")
+            return
+
+        source_path = Directory.resolve_path(context.chat_data.get('current_directory'), source)
+        destination_path = source_path.rpartition(PATH_SEPARATOR)[0] if source_path else None
+        FileSystemHandlers.__relocate(update, context, source_path, destination_path, name)
+
+    @staticmethod
+    def __relocate(update, context, source_path: str, destination_path: str, name: str = None):
+        """ Move directory to destination directory under given name and switch user, who was inside the moved
+            subtree, to its new path
+
+        :param source_path: path of moved directory
+        :param destination_path: path of new parent directory
+        :param name: new name of directory, None to keep the current one
+        """
+        if not source_path or source_path == ROOT_DIRECTORY:
+            update.message.reply_text("The root directory can't be moved or renamed")
+            return
+
+        user_id = Directory.encrypt_user_id(update.effective_user.id)
+        try:
+            with Directory.lock_tree(user_id):
+                directory = Directory.get_by_path(source_path, user_id)
+                parent = Directory.get_by_path(destination_path, user_id) if destination_path else None
+                if directory is None or parent is None:
+                    missing = source_path if directory is None else destination_path
+                    update.message.reply_text(f"There is no directory '{missing}'")
+                    return
+
+                name = name or directory.name
+                directory.relocate(parent, name)
+        except LeaseBusyError:
+            update.message.reply_text(TREE_BUSY_MESSAGE)
+            return
+        except NotUniqueError:
+            update.message.reply_text(f"The directory '{Directory.build_path(parent.path, name)}' already exists")
+            return
+        except ValueError:
+            update.message.reply_text(f"The directory '{source_path}' can't be moved inside itself")
+            return
+
+        current_path = context.chat_data.get('current_directory')
+        if current_path == source_path or current_path.startswith(source_path + PATH_SEPARATOR):
+            context.chat_data['current_directory'] = directory.path + current_path[len(source_path):]
+        update.message.reply_text(f"The directory '{source_path}' is moved to {directory.path}")
+
     @staticmethod
     @PreProcessors.set_root_directory
     def return_to_parent_directory(update, context):
         """ Moving user back to parent directory of current directory
         """
-        current_directory = Directory.objects.get(
-            name=context.chat_data.get('current_directory'),
-            user_id=Directory.encrypt_user_id(update.effective_user.id)
-        )
-        parent_directory = Directory.objects.get(
-            contains_directories=current_directory,
-            user_id=Directory.encrypt_user_id(update.effective_user.id)
+        current_directory = Directory.get_by_path(
+            context.chat_data.get('current_directory'),
+            Directory.encrypt_user_id(update.effective_user.id)
         )
+        parent_directory = current_directory.get_parent()
 
         def __handle_successfully_switched():
-            context.chat_data['current_directory'] = parent_directory.name
-            update.message.reply_text(f"You now switched to directory {parent_directory.name}")
+            context.chat_data['current_directory'] = parent_directory.path
+            update.message.reply_text(f"You now switched to directory {parent_directory.path}")
 
         def __handle_dir_with_no_parents():
             if current_directory.name != ROOT_DIRECTORY:
@@ -259,96 +485,492 @@ class FileSystemHandlers:
     @PreProcessors.set_root_directory
     def process_keyboard(update, context):
         """ A callback for go_to_directory() and remove_directory() methods, that perform directory change to
-            selected one
+            selected one. Button keeps signed ids of subdirectory and its parent, so the subdirectory is checked and
+            fetched with one query
         """
         query = update.callback_query
-        action, directory = query.data.split(',')
-        current_directory = Directory.objects.get(
-            name=context.chat_data.get('current_directory'),
-            user_id=Directory.encrypt_user_id(update.effective_user.id)
-        )
+        token = callbacks.verify(query.data, update.effective_user.id)
+        if token is None or (token[0] != DIRECTORY_ACTIONS['cancel'] and len(token[1]) != 2):
+            query.edit_message_text(EXPIRED_KEYBOARD_MESSAGE)
+            return
 
-        def _goto_handler(directory_name):
-            if current_directory.has_subdirectory(directory_name, Directory.encrypt_user_id(update.effective_user.id)):
-                context.chat_data['current_directory'] = directory_name
-                query.answer()
-                query.edit_message_text(text=f"You now switched to directory {directory_name}")
+        action, ids, _ = token
+        if action == DIRECTORY_ACTIONS['cancel']:
+            query.edit_message_text(text=f"Operation were canceled")
+            return
+
+        subdirectory = Directory.get_subdirectory(*ids, Directory.encrypt_user_id(update.effective_user.id))
+        if subdirectory is None:
+            query.edit_message_text("Seems, the directory is already deleted or moved")
+            return
+
+        def _goto_handler(directory):
+            context.chat_data['current_directory'] = directory.path
+            query.answer()
+            query.edit_message_text(text=f"You now switched to directory {directory.path}")
+
+        def _delete_handler(directory):
+            try:
+                with Directory.lock_tree(directory.user_id):
+                    deleted = directory.delete_subtree()
+            except LeaseBusyError:
+                query.edit_message_text(TREE_BUSY_MESSAGE)
+                return
+
+            query.edit_message_text(
+                f"The directory '{directory.name}' and it's files are successfully deleted from "
+                f"{directory.path.rpartition(PATH_SEPARATOR)[0]} directory (directories: {deleted['directories']}, "
+                f"files: {deleted['files']})"
+            )
 
-            else:
-                context.chat_data['current_directory'] = ROOT_DIRECTORY
-                logger.error(f"Unexpected accident: <directory.has_subdirectory> returned False for directory "
-                             f"{directory_name}. current_directory={current_directory}, action={action}, "
-                             f"directory={directory_name}. User were redirected to root directory")
+        action_map = {
+            DIRECTORY_ACTIONS['goto']: _goto_handler,
+            DIRECTORY_ACTIONS['delete']: _delete_handler,
+        }
+
+        handler = action_map.get(action)
+        if handler:
+            handler(subdirectory)
+        else:
+            query.edit_message_text(EXPIRED_KEYBOARD_MESSAGE)
 
-                query.edit_message_text(f"Wow, you've broke me somehow..\nSo i switched you to root directory")
+    @staticmethod
+    @PreProcessors.set_root_directory
+    def process_keyboard_page(update, context):
+        """ A callback for page buttons of go_to_directory() and remove_directory() keyboards, that shows another
+            page of subdirectories in the same message
+        """
+        query = update.callback_query
+        user_id = update.effective_user.id
+        token = callbacks.verify(query.data, user_id)
+        query.answer()
+        if token is None or len(token[0]) != 2 or len(token[1]) != 2:
+            query.edit_message_text(EXPIRED_KEYBOARD_MESSAGE)
+            return
+
+        (direction, action), (boundary_id, parent_id), _ = token
+        # the page is counted from the first or the last subdirectory of the page, where the button was pressed
+        boundary = Directory.get_subdirectory(boundary_id, parent_id, Directory.encrypt_user_id(user_id))
+        keyboard = None
+        if boundary:
+            keyboard = FileSystemHandlers.__render_subdirectories_page(
+                parent_id,
+                user_id,
+                action,
+                after=boundary.name if direction == DIRECTORY_ACTIONS['next'] else None,
+                before=boundary.name if direction == DIRECTORY_ACTIONS['previous'] else None
+            )
+        # subdirectories of the page could be deleted since the keyboard was sent
+        keyboard = keyboard or FileSystemHandlers.__render_subdirectories_page(parent_id, user_id, action)
+        if keyboard:
+            query.edit_message_reply_markup(reply_markup=keyboard)
+        else:
+            query.edit_message_text("There are no subdirectories in the directory anymore")
 
-        def _delete_handler(directory_name):
-            if current_directory.has_subdirectory(directory_name, Directory.encrypt_user_id(update.effective_user.id)):
-                subdirectory = Directory.objects.get(
-                    name=directory_name,
-                    user_id=Directory.encrypt_user_id(update.effective_user.id)
-                )
-                subdirectory.delete()
 
-                query.edit_message_text(
-                    f"The directory '{directory_name}' and it's files are successfully deleted from current "
-                    f"{current_directory.name} directory"
-                )
+class MediaHandlers:
+    @staticmethod
+    def __get_media(message) -> dict:
+        """ Get description of media, attached to message
+
+        :param message: Telegram message
+        :return: dict with media_type, file_id, file_unique_id, size, mime_type and name of media
+        """
+        media_type = next(media_type for media_type in MEDIA_TYPES if getattr(message, media_type))
+        # photo is a list of sizes, the last one is the biggest
+        media = message.photo[-1] if media_type == 'photo' else getattr(message, media_type)
+
+        return {
+            'media_type': media_type,
+            'file_id': media.file_id,
+            'file_unique_id': media.file_unique_id,
+            'size': media.file_size,
+            'mime_type': getattr(media, 'mime_type', None),
+            'name': message.caption or getattr(media, 'file_name', None),
+        }
+
+    @staticmethod
+    def __store_media(directory_name: str, chat_id: int, user_id: int, media: list) -> list:
+        """ Save media as files of directory. Media, that user uploaded before, get a reference to the existing
+            content record instead of a new one
+
+        :param directory_name: name of directory
+        :param chat_id: id of chat, that media was sent to
+        :param user_id: id of media owner
+        :param media: dicts with message_id and media description (see __get_media())
+        :return: saved File instances
+        :raises DoesNotExist: if directory doesn't exist
+        """
+        contents = Content.register(Directory.encrypt_user_id(user_id), media)
+        files = [
+            File(
+                telegram_id=item['message_id'],
+                lookup_digest=File.build_lookup_digest(chat_id, item['message_id']),
+                file_id=item['file_id'],
+                media_type=item['media_type'],
+                content=content_id,
+                name=item['name']
+            )
+            for item, content_id in zip(media, contents)
+        ]
+        saved = []
+        try:
+            saved = Directory.attach_files(directory_name, Directory.encrypt_user_id(user_id), files)
+        finally:
+            # messages, that are already stored or weren't saved, don't add references
+            saved_files = {id(file) for file in saved}
+            Content.release(Counter(
+                content_id for file, content_id in zip(files, contents) if id(file) not in saved_files
+            ))
+
+        return saved
+
+    @staticmethod
+    def __send_files(bot, chat_id: int, files: list):
+        """ Send files to chat. Photos and videos with known telegram file id are grouped to albums of up to
+            MEDIA_GROUP_SIZE items, other media types are sent one by one. Files, that were saved before file ids
+            were stored, are forwarded
+
+        :param bot: Telegram bot instance
+        :param chat_id: id of chat to send files to
+        :param files: list of File instances
+        """
+        def __send_one(media_type: str, file_id: str):
+            getattr(bot, f'send_{media_type}')(chat_id=chat_id, **{media_type: file_id})
+
+        def __send_album(album: list):
+            if len(album) == 1:
+                __send_one(*album[0])
             else:
-                query.edit_message_text(f"Seems, the directory '{directory_name}' is already deleted")
+                bot.send_media_group(
+                    chat_id=chat_id,
+                    media=[INPUT_MEDIA[media_type](file_id) for media_type, file_id in album]
+                )
 
-        if directory == CANCEL_BUTTON:
-            query.edit_message_text(text=f"Operation were canceled")
-        else:
-            action_map = {
-                DIRECTORY_ACTIONS['goto']: _goto_handler,
-                DIRECTORY_ACTIONS['delete']: _delete_handler,
-            }
+        album = []
+        file_ids = iter(File.prepare_file_ids([file.file_id for file in files if file.file_id]))
+        for file in files:
+            if file.file_id:
+                if file.media_type not in ALBUM_MEDIA_TYPES:
+                    # keep the order of files: the album, collected before the file, goes first
+                    if album:
+                        __send_album(album)
+                        album = []
+                    __send_one(file.media_type, next(file_ids))
+                    continue
+
+                album.append((file.media_type, next(file_ids)))
+                if len(album) == MEDIA_GROUP_SIZE:
+                    __send_album(album)
+                    album = []
+                continue
+
+            # user could delete the message of the file
+            bot.forward_message(
+                chat_id=chat_id,
+                from_chat_id=chat_id,
+                message_id=File.prepare_telegram_id(file.telegram_id),
+                ignore=ignore_bad_request('Message to forward not found')
+            )
 
-            handler = action_map[action]
-            handler(directory)
+        if album:
+            __send_album(album)
 
+    @staticmethod
+    def __send_files_page(bot, chat_id: int, user_id: int, directory: object, after: int, files: list = None):
+        """ Send one page of files from directory and a button to request the next one, if there are more files.
+            Button keeps signed id of the directory and position of the last sent file, so the next page is taken
+            from the same directory, even if user has switched to another one
+
+        :param bot: Telegram bot instance
+        :param chat_id: id of chat to send files to
+        :param user_id: id of user, who requested files
+        :param directory: Directory instance
+        :param after: position of the last file, that was already sent
+        :param files: files of the page, if they are already fetched
+        """
+        # one extra file is fetched to know, whether there is the next page
+        if files is None:
+            files = directory.get_files_page(after, SHOW_PAGE_SIZE + 1)
+        page = files[:SHOW_PAGE_SIZE]
+        MediaHandlers.__send_files(bot, chat_id, page)
+
+        if len(files) > SHOW_PAGE_SIZE:
+            keyboard = [[InlineKeyboardButton(NEXT_PAGE_BUTTON, callback_data=callbacks.sign(
+                MEDIA_ACTIONS['show'], user_id, directory.id, number=page[-1].position
+            ))]]
+            bot.send_message(
+                chat_id=chat_id,
+                text=f'Shown {len(page)} files from directory {directory.name}',
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
 
-class MediaHandlers:
     @staticmethod
     @PreProcessors.set_root_directory
-    def save_photo(update, context):
-        """ Add given photo to current directory
+    def save_media(update, context):
+        """ Add given photo, video, document, audio or voice message to current directory.
+            Media of an album is buffered and saved at once by save_album(), when the album window is over
         """
-        # create new record about the file in the DB
-        photo = File(telegram_id=update.message.message_id)
-        photo.save()
-        # attach new file to current directory
-        directory = Directory.objects.get(
-            name=context.chat_data.get('current_directory'),
-            user_id=Directory.encrypt_user_id(update.effective_user.id)
+        media = MediaHandlers.__get_media(update.message)
+        media['message_id'] = update.message.message_id
+        if update.message.media_group_id:
+            key = (update.effective_chat.id, update.effective_user.id, update.message.media_group_id)
+            media['directory'] = context.chat_data.get('current_directory')
+            if ALBUM_BUFFER.add(key, media):
+                context.job_queue.run_once(MediaHandlers.close_album, ALBUM_WINDOW, context=key)
+            return
+
+        directory_name = context.chat_data.get('current_directory')
+        # create new record about the file in current directory, if the message wasn't saved before
+        try:
+            MediaHandlers.__store_media(directory_name, update.effective_chat.id, update.effective_user.id, [media])
+        except DoesNotExist:
+            update.message.reply_text(f"Seems, the directory '{directory_name}' is deleted")
+            return
+
+        update.message.reply_text(f'Your file now live in directory {directory_name}')
+
+    @staticmethod
+    def close_album(context):
+        """ A job, that passes album, buffered by save_media(), to save_album() through the dispatcher, so it isn't
+            saved in the job queue thread
+        """
+        context.update_queue.put(AlbumReady(*context.job.context))
+
+    @staticmethod
+    def save_album(update, context):
+        """ Save media of an album, buffered by save_media(), with one bulk insert and reply once
+
+        :param update: AlbumReady event
+        """
+        chat_id, user_id = update.chat_id, update.user_id
+        media = ALBUM_BUFFER.pop(update.key)
+        if not media:
+            return
+
+        # the album is saved to directory, that was current, when its first item came
+        directory_name = media[0]['directory']
+        try:
+            MediaHandlers.__store_media(directory_name, chat_id, user_id, media)
+        except DoesNotExist:
+            context.bot.send_message(chat_id=chat_id, text=f"Seems, the directory '{directory_name}' is deleted")
+            return
+
+        context.bot.send_message(
+            chat_id=chat_id,
+            text=f'Your {len(media)} files now live in directory {directory_name}'
+        )
+
+    @staticmethod
+    def show_stats(update, context):
+        """ Send amount of stored files and size, that was saved by deduplication of repeated uploads
+        """
+        stats = Content.stats(Directory.encrypt_user_id(update.effective_user.id))
+        update.message.reply_text(
+            f"Stored files: {stats['references']}, unique: {stats['records']}\n"
+            f"Size of unique files: {stats['size'] / 2 ** 20:.1f} MB\n"
+            f"Saved by deduplication: {stats['saved_size'] / 2 ** 20:.1f} MB"
         )
-        directory.update(add_to_set__contains_files=photo)
-        directory.save()
-        update.message.reply_text(f'Your file now live in directory {directory.name}')
 
     @staticmethod
     @PreProcessors.set_root_directory
     def show_photo(update, context):
-        """ Send all photos from current directory
+        """ Send the first page of files from current directory
+        """
+        directory = Directory.get_by_path(
+            context.chat_data.get('current_directory'),
+            Directory.encrypt_user_id(update.effective_user.id)
+        )
+        files = directory.get_files_page(0, SHOW_PAGE_SIZE + 1)
+        if not files:
+            update.message.reply_text('There are no files stored in current directory')
+        else:
+            MediaHandlers.__send_files_page(
+                context.bot, update.effective_chat.id, update.effective_user.id, directory, 0, files
+            )
+
+    @staticmethod
+    def show_photo_page(update, context):
+        """ A callback for "next page" button of show_photo() method, that sends the next page of files from the
+            directory, that the button was sent for
         """
+        query = update.callback_query
+        user_id = update.effective_user.id
+        token = callbacks.verify(query.data, user_id)
+        query.answer()
+        if token is None or token[0] != MEDIA_ACTIONS['show'] or len(token[1]) != 1 or token[2] is None:
+            query.edit_message_text(EXPIRED_KEYBOARD_MESSAGE)
+            return
+
+        _, (directory_id,), after = token
         directory = Directory.objects.get(
-            name=context.chat_data.get('current_directory'),
-            user_id=Directory.encrypt_user_id(update.effective_user.id)
+            id=directory_id, user_id=Directory.encrypt_user_id(user_id), pending_delete__ne=True
         )
-        if not directory.contains_files:
-            update.message.reply_text('There are no photos stored in current directory')
+        if directory is None:
+            query.edit_message_text("Seems, the directory is already deleted")
+            return
+
+        query.edit_message_reply_markup(reply_markup=None)
+        MediaHandlers.__send_files_page(context.bot, update.effective_chat.id, user_id, directory, after)
+
+
+class SearchHandlers:
+    @staticmethod
+    def __render_page(user_id: int, prefix: str, offset: int) -> tuple:
+        """ Build text and keyboard of search results page. Every hit is a button, that switches user to the found
+            directory or to directory of the found file
+
+        :param user_id: id of user
+        :param prefix: prefix of name to search
+        :param offset: amount of hits on previous pages
+        :return: text and InlineKeyboardMarkup or None, if nothing is found
+        """
+        hits = search.find(Directory.encrypt_user_id(user_id), prefix, offset, SEARCH_PAGE_SIZE + 1)
+        if not hits:
+            return f"Nothing is found by '{prefix}'", None
+
+        keyboard = [
+            [InlineKeyboardButton(label, callback_data=f"{SEARCH_ACTIONS['jump']},{directory_id}")]
+            for _, label, directory_id in hits[:SEARCH_PAGE_SIZE]
+        ]
+        navigation = []
+        if offset:
+            navigation.append(InlineKeyboardButton(
+                PREVIOUS_PAGE_BUTTON,
+                callback_data=f"{SEARCH_ACTIONS['page']},{max(offset - SEARCH_PAGE_SIZE, 0)},{prefix}"
+            ))
+        if len(hits) > SEARCH_PAGE_SIZE:
+            navigation.append(InlineKeyboardButton(
+                NEXT_PAGE_BUTTON, callback_data=f"{SEARCH_ACTIONS['page']},{offset + SEARCH_PAGE_SIZE},{prefix}"
+            ))
+        if navigation:
+            keyboard.append(navigation)
+
+        return f"Found by '{prefix}', choose one to go to its directory", InlineKeyboardMarkup(keyboard)
+
+    @staticmethod
+    @PreProcessors.set_root_directory
+    def find(update, context):
+        """ Find directories and files by prefix of their name
+        """
+        prefix = ' '.join(context.args)
+        if not prefix:
+            update.message.reply_text('Command /find requires a prefix of name to search')
+            return
+        if len(prefix.encode()) > SEARCH_PREFIX_MAX_SIZE:
+            update.message.reply_text(f'Prefix is too long, it could take up to {SEARCH_PREFIX_MAX_SIZE} bytes')
+            return
+
+        text, keyboard = SearchHandlers.__render_page(update.effective_user.id, prefix, 0)
+        update.message.reply_text(text, reply_markup=keyboard)
+
+    @staticmethod
+    @PreProcessors.set_root_directory
+    def find_page(update, context):
+        """ A callback for page buttons of find() method, that shows another page of search results. Button keeps
+            the prefix, so pages of an older search are not mixed up with the newest one
+        """
+        query = update.callback_query
+        parts = query.data.split(',', 2)
+        query.answer()
+        if len(parts) != 3 or not parts[1].isdigit() or not parts[2]:
+            query.edit_message_text('Search results are expired, please use /find again')
+            return
+
+        _, offset, prefix = parts
+        text, keyboard = SearchHandlers.__render_page(update.effective_user.id, prefix, int(offset))
+        query.edit_message_text(text, reply_markup=keyboard)
+
+    @staticmethod
+    @PreProcessors.set_root_directory
+    def jump_to_directory(update, context):
+        """ A callback for search result buttons, that switches user to selected directory without walking the tree
+        """
+        query = update.callback_query
+        _, directory_id = query.data.split(',')
+        query.answer()
+
+        directory = None
+        if ObjectId.is_valid(directory_id):
+            directory = Directory.objects.get(
+                id=directory_id,
+                user_id=Directory.encrypt_user_id(update.effective_user.id),
+                pending_delete__ne=True
+            )
+
+        if directory:
+            context.chat_data['current_directory'] = directory.path
+            query.edit_message_text(text=f"You now switched to directory {directory.path}")
         else:
-            for photo in directory.contains_files:
-                try:
-                    context.bot.forward_message(
-                        chat_id=update.effective_chat.id,
-                        from_chat_id=update.effective_chat.id,
-                        message_id=File.prepare_telegram_id(photo.telegram_id)
-                    )
-                except BadRequest as bad_request:
-                    no_message = 'Message to forward not found'
-                    if str(bad_request) == no_message:
-                        continue
-                    else:
-                        raise
+            query.edit_message_text(text=f"Seems, the directory is already deleted")
+
+
+class BackupHandlers:
+    @staticmethod
+    def export(update, context):
+        """ Send export of the whole directory tree of user as a document. Export is streamed to a temporary file,
+            so memory doesn't depend on amount of stored files
+        """
+        user_id = update.effective_user.id
+        with tempfile.TemporaryFile() as archive:
+            counts = backup.write_export(user_id, archive, compress=True)
+            if archive.tell() > EXPORT_MAX_SIZE:
+                update.message.reply_text(
+                    f'Your export takes {archive.tell() / 2 ** 20:.1f} MB, that is more than a bot could send. '
+                    f'Please ask administrator to export it for you'
+                )
+                return
+
+            archive.seek(0)
+            # the archive is uploaded by the sender thread, so it is kept open until the document is sent
+            resolved(context.bot.send_document(
+                chat_id=update.effective_chat.id,
+                document=archive,
+                filename=f"telegram_cloud_{datetime.utcnow():%Y%m%d}.ndjson.gz",
+                caption=f"Exported directories: {counts.get('directory', 0)}, files: {counts.get('file', 0)}"
+            ))
+
+    @staticmethod
+    def import_tree(update, context):
+        """ Restore export, that /import command replies to, into the directory tree of user. Records are written
+            by bulk inserts, progress is reported by editing of status message
+        """
+        reply = update.message.reply_to_message
+        document = reply.document if reply else None
+        if document is None:
+            update.message.reply_text('Please send /import as a reply to the message with your export')
+            return
+        if document.file_size and document.file_size > IMPORT_MAX_SIZE:
+            update.message.reply_text(
+                f'Your export takes {document.file_size / 2 ** 20:.1f} MB, that is more than a bot could download. '
+                f'Please ask administrator to import it for you'
+            )
+            return
+
+        # status message is edited during import, so it is sent as a reply, that is never merged with other texts
+        status = resolved(update.message.reply_text('Import is started', quote=True))
+
+        def __progress(counts):
+            # progress could be the same as the previous one
+            status.edit_text(
+                f"Imported directories: {counts.get('directory', 0)}, files: {counts.get('file', 0)}, "
+                f"{counts['records_per_second']} records per second",
+                ignore=ignore_bad_request('Message is not modified')
+            )
+
+        with tempfile.TemporaryFile() as archive:
+            context.bot.get_file(document.file_id).download(out=archive)
+            archive.seek(0)
+            try:
+                counts = backup.import_tree(archive, update.effective_user.id, progress=__progress)
+            except BackupFormatError as error:
+                status.edit_text(f'Import is failed: {error}')
+                return
+            except LeaseBusyError:
+                status.edit_text(TREE_BUSY_MESSAGE)
+                return
+
+        status.edit_text(
+            f"Import is finished in {counts['seconds']:.1f} s. Imported directories: {counts.get('directory', 0)}, "
+            f"files: {counts.get('file', 0)}, skipped as already stored: {counts.get('skipped', 0)}"
+        )
@@ -0,0 +1,75 @@
+import random
+import atexit
+from queue import Queue, Full
+from threading import Lock
+from logging import Filter, WARNING
+from logging.handlers import QueueHandler, QueueListener
+
+
+class SamplingFilter(Filter):
+    """ Pass only a sample of records below WARNING level, records of WARNING level and above always pass
+    """
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record) -> bool:
+        return record.levelno >= WARNING or self.rate >= 1 or random.random() < self.rate
+
+
+class QueueWriter(QueueListener):
+    """ QueueListener, that could be stopped, when the queue is full, and could be stopped twice
+    """
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+    def stop(self):
+        if self._thread:
+            super().stop()
+
+
+class BoundedQueueHandler(QueueHandler):
+    """ Puts log records to bounded queue, that is written by QueueListener thread, so logging never blocks caller
+        on file I/O and rotation. Records are dropped, when the queue is full
+    """
+    def __init__(self, queue: Queue):
+        super().__init__(queue)
+        self.listener = None
+        self.dropped = 0
+        self._lock = Lock()
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            with self._lock:
+                self.dropped += 1
+
+    def stats(self) -> dict:
+        return {
+            'queue_depth': self.queue.qsize(),
+            'queue_size': self.queue.maxsize,
+            'dropped': self.dropped,
+        }
+
+
+def install_queue(logger, queue_size: int, sample_rate: float = 1.0) -> BoundedQueueHandler:
+    """ Move handlers of logger behind a bounded queue, written by background listener thread
+
+    :param logger: configured logger
+    :param queue_size: max amount of records, waiting to be written
+    :param sample_rate: share of records below WARNING level to keep
+    :return: handler, that is installed to logger
+    """
+    handler = BoundedQueueHandler(Queue(queue_size))
+    handler.addFilter(SamplingFilter(sample_rate))
+    handler.listener = QueueWriter(handler.queue, *logger.handlers, respect_handler_level=True)
+
+    for target in list(logger.handlers):
+        logger.removeHandler(target)
+    logger.addHandler(handler)
+
+    handler.listener.start()
+    # write the rest of queued records on exit
+    atexit.register(handler.listener.stop)
+    return handler
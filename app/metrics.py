@@ -0,0 +1,222 @@
+import time
+from bisect import bisect_left
+from threading import Lock, Thread, local
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pymongo.monitoring import CommandListener
+from app import logger
+from app.config import METRICS_PREFIX, METRICS_BUCKETS, DATABASE_EVENT_LISTENERS
+
+# counters of the update, that is handled by current thread
+TRACE = local()
+
+
+class Histogram:
+    """ Cumulative histogram of observed values with fixed bucket bounds
+    """
+    def __init__(self, buckets: tuple):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> list:
+        """ Get amount of values, that are less or equal to every bucket bound and to +Inf
+        """
+        result = []
+        total = 0
+        for count in self.counts:
+            total += count
+            result.append(total)
+
+        return result
+
+
+class MetricsRegistry:
+    """ Thread-safe registry of histograms and counters, that renders them in Prometheus text format.
+        Stats of other components are collected on render by registered collectors
+    """
+    def __init__(self, prefix: str, buckets: tuple):
+        self.prefix = prefix
+        self.buckets = buckets
+        self._histograms = {}
+        self._counters = {}
+        self._collectors = {}
+        self._lock = Lock()
+
+    def observe(self, name: str, labels: dict, value: float, buckets: tuple = None):
+        """ Add value to histogram
+
+        :param name: name of histogram, e.g. 'handler_seconds'
+        :param labels: labels of histogram
+        :param value: observed value
+        :param buckets: bucket bounds of the histogram, if they differ from default ones, e.g. for counts
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets or self.buckets)
+            histogram.observe(value)
+
+    def inc(self, name: str, labels: dict, amount: float = 1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def collect(self, name: str, callback):
+        """ Register collector of gauges
+
+        :param name: name of gauges group, e.g. 'send_queue'
+        :param callback: function, that returns dict of numeric stats
+        """
+        self._collectors[name] = callback
+
+    def render(self) -> str:
+        """ Render all metrics in Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            histograms = sorted(
+                (name, labels, histogram.buckets, list(histogram.cumulative_counts()), histogram.sum, histogram.count)
+                for (name, labels), histogram in self._histograms.items()
+            )
+            counters = sorted(self._counters.items())
+
+        declared = set()
+        for name, labels, buckets, counts, total, count in histograms:
+            name = f'{self.prefix}_{name}'
+            if name not in declared:
+                declared.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            for bound, amount in zip(buckets + ('+Inf',), counts):
+                lines.append(f'{name}_bucket{self.__labels(labels + (("le", bound),))} {amount}')
+            lines.append(f'{name}_sum{self.__labels(labels)} {total}')
+            lines.append(f'{name}_count{self.__labels(labels)} {count}')
+
+        for (name, labels), value in counters:
+            name = f'{self.prefix}_{name}'
+            if name not in declared:
+                declared.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{self.__labels(labels)} {value}')
+
+        for group, callback in sorted(self._collectors.items()):
+            try:
+                stats = callback()
+            except Exception as error:
+                logger.warning(f'Failed to collect {group} metrics: {error}')
+                continue
+            for key, value in sorted(stats.items()):
+                if isinstance(value, (int, float)):
+                    lines.append(f'# TYPE {self.prefix}_{group}_{key} gauge')
+                    lines.append(f'{self.prefix}_{group}_{key} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def __labels(labels: tuple) -> str:
+        if not labels:
+            return ''
+
+        def __escape(value) -> str:
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        return '{' + ','.join(f'{name}="{__escape(value)}"' for name, value in labels) + '}'
+
+
+METRICS = MetricsRegistry(METRICS_PREFIX, METRICS_BUCKETS)
+
+
+def begin_trace():
+    """ Start counting DB queries and Bot API calls, made by current thread
+    """
+    TRACE.counters = {'mongo_queries': 0, 'mongo_seconds': 0.0, 'telegram_calls': 0, 'telegram_seconds': 0.0}
+
+
+def end_trace() -> dict:
+    """ Stop counting and get counters of current thread
+    """
+    counters = getattr(TRACE, 'counters', None) or {}
+    TRACE.counters = None
+    return counters
+
+
+def add_to_trace(kind: str, seconds: float):
+    """ Count call of current thread, if it is traced
+
+    :param kind: 'mongo' or 'telegram'
+    :param seconds: duration of the call
+    """
+    counters = getattr(TRACE, 'counters', None)
+    if counters is not None:
+        counters['mongo_queries' if kind == 'mongo' else 'telegram_calls'] += 1
+        counters[f'{kind}_seconds'] += seconds
+
+
+class CommandTimer(CommandListener):
+    """ pymongo command listener, that records latency of DB commands. Events are published by the thread, that runs
+        the command, so the command is also counted in trace of the handled update
+    """
+    def __init__(self):
+        self._started = {}
+
+    def started(self, event):
+        self._started[event.request_id] = time.perf_counter()
+
+    def succeeded(self, event):
+        self.__finish(event, 'succeeded')
+
+    def failed(self, event):
+        self.__finish(event, 'failed')
+
+    def __finish(self, event, status: str):
+        started = self._started.pop(event.request_id, None)
+        if started is None:
+            return
+
+        duration = time.perf_counter() - started
+        METRICS.observe('mongo_command_seconds', {'command': event.command_name, 'status': status}, duration)
+        add_to_trace('mongo', duration)
+
+
+DATABASE_EVENT_LISTENERS.append(CommandTimer())
+
+
+class MetricsServer:
+    """ Local HTTP server, that exposes METRICS in Prometheus text format on /metrics
+    """
+    def __init__(self, host: str, port: int):
+        registry = METRICS
+
+        class __Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), __Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._server.serve_forever, name='metrics_server', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
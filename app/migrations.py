@@ -0,0 +1,197 @@
+""" Online data migrations. They are idempotent and could be run while the bot is serving users:
+
+    python -m app.migrations <migration name>
+
+    Caches of bot processes are not shared with the migration: cached directories expire in DIRECTORY_CACHE_TTL,
+    search prefix trees are kept until directories of the user are changed. Restart the bot to see migrated data
+    at once
+"""
+import argparse
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import OperationFailure
+from app import logger
+from app.config import ROOT_DIRECTORY
+from app.models import Directory, File
+
+BATCH_SIZE = 500
+
+
+def backfill_parent_pointers(batch_size: int = BATCH_SIZE) -> int:
+    """ Fill <parent> field of directories, created before parent pointers were introduced
+
+    :param batch_size: amount of directories, processed per one bulk write
+    :return: amount of updated directories
+    """
+    collection = Directory._get_collection()
+    cursor = collection.find(
+        {'contains_directories.0': {'$exists': True}},
+        {'contains_directories': 1},
+        batch_size=batch_size
+    )
+    updated = 0
+    requests = []
+    for directory in cursor:
+        requests.append(UpdateMany(
+            {'_id': {'$in': directory['contains_directories']}, 'parent': None},
+            {'$set': {'parent': directory['_id']}}
+        ))
+        if len(requests) >= batch_size:
+            updated += collection.bulk_write(requests, ordered=False).modified_count
+            requests = []
+
+    if requests:
+        updated += collection.bulk_write(requests, ordered=False).modified_count
+
+    return updated
+
+
+def backfill_lookup_digests(batch_size: int = BATCH_SIZE) -> int:
+    """ Fill indexed <lookup_digest> of files, saved before it was introduced. Files are saved from private chats,
+        so chat id is the id of directory owner
+
+    :param batch_size: amount of files, processed per one bulk write
+    :return: amount of updated files
+    """
+    files_collection = File._get_collection()
+    cursor = Directory._get_collection().find({}, {'user_id': 1, 'contains_files': 1}, batch_size=batch_size)
+    updated = 0
+    for directory in cursor:
+        chat_id = Directory.decrypt_user_id(directory['user_id'])
+        files = files_collection.find(
+            {
+                '$or': [{'directory': directory['_id']}, {'_id': {'$in': directory.get('contains_files', [])}}],
+                'lookup_digest': None
+            },
+            {'telegram_id': 1}
+        )
+        requests = []
+        for file in files:
+            message_id = File.prepare_telegram_id(file['telegram_id'])
+            requests.append(UpdateOne(
+                {'_id': file['_id']},
+                {'$set': {'lookup_digest': File.build_lookup_digest(chat_id, message_id)}}
+            ))
+        for start in range(0, len(requests), batch_size):
+            updated += files_collection.bulk_write(requests[start:start + batch_size], ordered=False).modified_count
+
+    return updated
+
+
+def move_file_membership(batch_size: int = BATCH_SIZE) -> int:
+    """ Move files from <contains_files> list of directory document to <directory> and <position> fields of files.
+        Files keep their order in the list as upload order. The list is removed, when all its files are moved
+
+    :param batch_size: amount of files, processed per one bulk write
+    :return: amount of moved files
+    """
+    collection = Directory._get_collection()
+    files_collection = File._get_collection()
+    cursor = collection.find({'contains_files': {'$exists': True}}, {'contains_files': 1}, batch_size=batch_size)
+    moved = 0
+    for directory in cursor:
+        file_ids = directory['contains_files']
+        for start in range(0, len(file_ids), batch_size):
+            requests = [
+                UpdateOne(
+                    {'_id': file_id, 'directory': None},
+                    {'$set': {'directory': directory['_id'], 'position': position}}
+                )
+                for position, file_id in enumerate(file_ids[start:start + batch_size], start=start + 1)
+            ]
+            moved += files_collection.bulk_write(requests, ordered=False).modified_count
+
+        collection.update_one(
+            {'_id': directory['_id']},
+            {'$max': {'last_file_position': len(file_ids)}, '$unset': {'contains_files': ''}}
+        )
+
+    return moved
+
+
+def backfill_search_keys(batch_size: int = BATCH_SIZE) -> int:
+    """ Fill indexed <search_key> of directories, created before /find was introduced
+
+    :param batch_size: amount of directories, processed per one bulk write
+    :return: amount of updated directories
+    """
+    collection = Directory._get_collection()
+    cursor = collection.find({'search_key': None}, {'name': 1}, batch_size=batch_size)
+    updated = 0
+    requests = []
+    for directory in cursor:
+        requests.append(UpdateOne({'_id': directory['_id']}, {'$set': {'search_key': directory['name'].lower()}}))
+        if len(requests) >= batch_size:
+            updated += collection.bulk_write(requests, ordered=False).modified_count
+            requests = []
+
+    if requests:
+        updated += collection.bulk_write(requests, ordered=False).modified_count
+
+    return updated
+
+
+def backfill_paths(batch_size: int = BATCH_SIZE) -> int:
+    """ Fill indexed <path> of directories, created before paths were introduced, walking trees from root
+        directories level by level by parent pointers, so 'parent_pointers' migration should be run first.
+        <contains_directories> lists are removed and unique index of names is dropped, so names are unique only
+        inside parent directory
+
+    :param batch_size: amount of directories, processed per one bulk write
+    :return: amount of updated directories
+    """
+    collection = Directory._get_collection()
+    level = {
+        directory['_id']: directory['name']
+        for directory in collection.find({'parent': None, 'name': ROOT_DIRECTORY}, {'name': 1})
+    }
+    updated = 0
+    while level:
+        requests = [
+            UpdateOne({'_id': directory_id}, {'$set': {'path': path}, '$unset': {'contains_directories': ''}})
+            for directory_id, path in level.items()
+        ]
+        for start in range(0, len(requests), batch_size):
+            updated += collection.bulk_write(requests[start:start + batch_size], ordered=False).modified_count
+
+        parent_ids = list(level)
+        children = {}
+        for start in range(0, len(parent_ids), batch_size):
+            for directory in collection.find(
+                {'parent': {'$in': parent_ids[start:start + batch_size]}},
+                {'name': 1, 'parent': 1},
+                batch_size=batch_size
+            ):
+                children[directory['_id']] = Directory.build_path(level[directory['parent']], directory['name'])
+        level = children
+
+    try:
+        collection.drop_index('name_1_user_id_1')
+    except OperationFailure:
+        # index is already dropped
+        pass
+
+    return updated
+
+
+MIGRATIONS = {
+    'parent_pointers': backfill_parent_pointers,
+    'lookup_digests': backfill_lookup_digests,
+    'file_membership': move_file_membership,
+    'search_keys': backfill_search_keys,
+    'paths': backfill_paths,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run online data migration')
+    parser.add_argument('migration', choices=sorted(MIGRATIONS))
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    result = MIGRATIONS[args.migration](batch_size=args.batch_size)
+    logger.info(f'Migration {args.migration} is finished: {result}')
+    print(f'Migration {args.migration} is finished: {result}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,30 @@
+import re
+import hmac
 import json
+import time
+import uuid
 import base64
-from collections import deque
-from datetime import datetime
-from mongoengine import (Document, StringField, DateTimeField, ReferenceField, ListField, QuerySet, BinaryField,
-                         signals, NULLIFY, CASCADE, PULL)
-from mongoengine.errors import DoesNotExist
-from app.config import MONGO_ENGINE_ALIAS, CRYPTO
+import hashlib
+from contextlib import contextmanager
+from itertools import chain
+from collections import deque, Counter
+from datetime import datetime, timedelta
+from bson import Binary, ObjectId
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from mongoengine import (Document, StringField, DateTimeField, ReferenceField, QuerySet, BinaryField, BooleanField,
+                         LongField, DictField, signals, NULLIFY, CASCADE)
+from mongoengine.errors import DoesNotExist, NotUniqueError, BulkWriteError as BulkInsertError
+from app.config import (MONGO_ENGINE_ALIAS, CRYPTO, DIRECTORY_CACHE_SIZE, DIRECTORY_CACHE_TTL, DECRYPT_CACHE_SIZE,
+                        BULK_DELETE_BATCH_SIZE, MEDIA_TYPES, SEARCH_CACHE_SIZE, SEARCH_CACHE_MAX_NAMES, LEASE_TTL,
+                        LEASE_WAIT, PATH_SEPARATOR, ROOT_DIRECTORY, register_database)
+from app.errors import LeaseBusyError
+from app.cache import LRUCache
+
+DIRECTORY_CACHE = LRUCache(DIRECTORY_CACHE_SIZE, DIRECTORY_CACHE_TTL)
+DECRYPT_CACHE = LRUCache(DECRYPT_CACHE_SIZE)
+# search indexes by encrypted user id, weighted by amount of names in them
+SEARCH_CACHE = LRUCache(SEARCH_CACHE_SIZE, max_weight=SEARCH_CACHE_MAX_NAMES)
 
 
 def apply_signal(event):
@@ -33,6 +52,19 @@ def datetime_for_pre_save(sender, document):
     BaseFieldsMixin.add_datetime_fields(document)
 
 
+@apply_signal(signals.post_save)
+def cache_for_post_save(sender, document, **kwargs):
+    DIRECTORY_CACHE.invalidate(Directory.cache_key(document.user_id, document.path))
+    SEARCH_CACHE.invalidate(bytes(document.user_id))
+
+
+@apply_signal(signals.post_delete)
+def cache_for_directory_post_delete(sender, document, **kwargs):
+    # subdirectories are deleted together with the directory, so every cached directory of the user could be stale
+    DIRECTORY_CACHE.invalidate_where(lambda key, directory: key[0] == document.user_id)
+    SEARCH_CACHE.invalidate(bytes(document.user_id))
+
+
 class QueryMixin:
     def to_json(self) -> dict:
         """ Convert model instance to JSON representation
@@ -94,6 +126,15 @@ class BaseFieldsMixin:
         instance.updated = datetime.utcnow()
 
 
+class LazyConnectionMixin:
+    """ Registers DB connection on the first query of a model instead of import time
+    """
+    @classmethod
+    def _get_db(cls):
+        register_database()
+        return super()._get_db()
+
+
 class CustomQuerySet(QueryMixin, QuerySet):
     """ Modified mongoengine QuerySet class. Created prevent raising exception,
         when there is no data in DB by given key (.get() method)
@@ -105,24 +146,233 @@ class CustomQuerySet(QueryMixin, QuerySet):
             return None
 
 
+@datetime_for_pre_save.apply
+class Content(LazyConnectionMixin, BaseFieldsMixin, QueryMixin, Document):
+    """ Content address of media, uploaded by user. Media with the same telegram file_unique_id is recorded once
+        per user and is referenced by every File, that it is saved as, so duplicate upload only increments
+        <references> counter
+    """
+    user_id = BinaryField(required=True, null=False)
+    digest = StringField(required=True, null=False)
+    media_type = StringField(choices=MEDIA_TYPES)
+    mime_type = StringField()
+    size = LongField(default=0)
+    references = LongField(default=0)
+
+    meta = {
+        "db_alias": MONGO_ENGINE_ALIAS,
+        "queryset_class": CustomQuerySet,
+        "indexes": [
+            {"fields": ('user_id', 'digest'), 'unique': True}
+        ]
+    }
+
+    @staticmethod
+    def build_digest(file_unique_id: str) -> str:
+        """ Build keyed digest of telegram file_unique_id, that is the same for the same file
+
+        :param file_unique_id: unique id of telegram file
+        :return: hex HMAC digest
+        """
+        return hmac.new(CRYPTO.lookup_key, f'content:{file_unique_id}'.encode(), hashlib.sha256).hexdigest()
+
+    @classmethod
+    def register(cls, encrypted_user_id: bytes, media: list) -> list:
+        """ Add reference to content of every uploaded media. Content records are created for media, that user
+            didn't upload before. One media takes one upsert, that returns the id, several ones take one bulk upsert
+            and a query of ids of contents, that already existed
+
+        :param encrypted_user_id: encrypted id of media owner
+        :param media: dicts with file_unique_id, media_type, mime_type and size of media
+        :return: ids of content records in the same order
+        """
+        collection = cls._get_collection()
+        digests = [cls.build_digest(item['file_unique_id']) for item in media]
+        now = datetime.utcnow()
+        # ids of new contents are set by upserts, so ids of inserted contents are known without a query
+        new_ids = [ObjectId() for _ in media]
+        updates = [
+            {
+                '$inc': {'references': 1},
+                '$set': {'updated': now},
+                '$setOnInsert': {
+                    '_id': content_id,
+                    'media_type': item['media_type'],
+                    'mime_type': item.get('mime_type'),
+                    'size': item.get('size') or 0,
+                    'created': now,
+                }
+            }
+            for item, content_id in zip(media, new_ids)
+        ]
+        if len(media) == 1:
+            query = {'user_id': encrypted_user_id, 'digest': digests[0]}
+            try:
+                content = collection.find_one_and_update(
+                    query, updates[0], {'_id': 1}, upsert=True, return_document=ReturnDocument.AFTER
+                )
+            except DuplicateKeyError:
+                # concurrent upsert of the same content has inserted it first, the reference is added again
+                content = collection.find_one_and_update(query, updates[0], {'_id': 1})
+            return [content['_id']]
+
+        requests = [
+            UpdateOne({'user_id': encrypted_user_id, 'digest': digest}, update, upsert=True)
+            for digest, update in zip(digests, updates)
+        ]
+        try:
+            inserted = set(collection.bulk_write(requests).upserted_ids.values())
+        except BulkWriteError as error:
+            # concurrent upsert of the same content has inserted it first, the rest of references are added again
+            if any(write_error['code'] != 11000 for write_error in error.details['writeErrors']):
+                raise
+            inserted = {upserted['_id'] for upserted in error.details['upserted']}
+            inserted.update(
+                collection.bulk_write(requests[error.details['writeErrors'][0]['index']:]).upserted_ids.values()
+            )
+
+        # ids of contents, that already existed, by digest
+        existing = {}
+        matched = [digest for digest, content_id in zip(digests, new_ids) if content_id not in inserted]
+        if matched:
+            existing = {
+                content['digest']: content['_id']
+                for content in collection.find(
+                    {'user_id': encrypted_user_id, 'digest': {'$in': matched}}, {'digest': 1}
+                )
+            }
+        return [
+            content_id if content_id in inserted else existing[digest] for digest, content_id in zip(digests, new_ids)
+        ]
+
+    @classmethod
+    def release(cls, references: Counter):
+        """ Remove references to contents and delete content records, that are not referenced anymore
+
+        :param references: amount of removed references by content id
+        """
+        if not references:
+            return
+
+        collection = cls._get_collection()
+        collection.bulk_write([
+            UpdateOne({'_id': content_id}, {'$inc': {'references': -amount}})
+            for content_id, amount in references.items()
+        ], ordered=False)
+        collection.delete_many({'_id': {'$in': list(references)}, 'references': {'$lte': 0}})
+
+    @classmethod
+    def stats(cls, encrypted_user_id: bytes) -> dict:
+        """ Get amount of unique media records of user, references to them and bytes, that weren't stored again
+            thanks to deduplication
+
+        :param encrypted_user_id: encrypted id of media owner
+        :return: dict with records, references, size and saved_size
+        """
+        result = list(cls._get_collection().aggregate([
+            {'$match': {'user_id': encrypted_user_id}},
+            {'$group': {
+                '_id': None,
+                'records': {'$sum': 1},
+                'references': {'$sum': '$references'},
+                'size': {'$sum': '$size'},
+                'saved_size': {'$sum': {'$multiply': ['$size', {'$subtract': ['$references', 1]}]}},
+            }},
+        ]))
+        stats = {'records': 0, 'references': 0, 'size': 0, 'saved_size': 0}
+        if result:
+            stats.update({key: result[0][key] for key in stats})
+
+        return stats
+
+
 @datetime_for_pre_bulk_insert.apply
 @datetime_for_pre_save.apply
-class File(BaseFieldsMixin, AdditionalOperationsMixin, QueryMixin, Document):
+class File(LazyConnectionMixin, BaseFieldsMixin, AdditionalOperationsMixin, QueryMixin, Document):
     """ Represents File entity, that stores information about telegram file
     """
     telegram_id = BinaryField(required=True, null=False, unique=True)
+    lookup_digest = StringField(unique=True, sparse=True)
+    file_id = BinaryField()
+    media_type = StringField(choices=MEDIA_TYPES, default='photo')
+    content = ReferenceField(Content)
+    # caption or file name, that file could be found by
+    name = StringField()
+    search_key = StringField()
+    user_id = BinaryField()
+
+    directory = ReferenceField("Directory")
+    # upload order of file inside its directory, reserved by Directory.last_file_position counter
+    position = LongField()
 
     meta = {
         "db_alias": MONGO_ENGINE_ALIAS,
         "collections": "filesystem",
-        "queryset_class": CustomQuerySet
+        "queryset_class": CustomQuerySet,
+        "indexes": [
+            {"fields": ('directory', 'position')},
+            {"fields": ('user_id', 'search_key')}
+        ]
     }
 
     def clean(self):
-        """ Encrypt telegram_id field before saving
+        """ Encrypt telegram_id and file_id fields and build search key before saving
+        """
+        if self.name:
+            self.search_key = self.name.lower()
+        if not isinstance(self.telegram_id, bytes):
+            self.telegram_id = CRYPTO.encrypt(str(self.telegram_id).encode())
+        if self.file_id and not isinstance(self.file_id, bytes):
+            self.file_id = CRYPTO.encrypt(self.file_id.encode())
+
+    @staticmethod
+    def build_lookup_digest(chat_id: int, message_id: int) -> str:
+        """ Build deterministic keyed digest of telegram message. Unlike encrypted telegram_id, it is the same for
+            the same message, so it is indexed to find files by message and to catch duplicates
+
+        :param chat_id: id of chat, that message was sent to
+        :param message_id: telegram message id
+        :return: hex HMAC digest
+        """
+        return hmac.new(CRYPTO.lookup_key, f'{chat_id}:{message_id}'.encode(), hashlib.sha256).hexdigest()
+
+    @classmethod
+    def delete_releasing(cls, files_filter: dict) -> int:
+        """ Delete files, that match the filter, and remove their references to contents. References are released
+            only for files, that were deleted, so interrupted deletion could be repeated without releasing the same
+            references twice (crash after delete leaves extra references, that only keep contents longer)
+
+        :param files_filter: raw query of files collection
+        :return: amount of deleted files
+        """
+        collection = cls._get_collection()
+        files = list(collection.find(files_filter, projection={'content': 1}))
+        if not files:
+            return 0
+
+        deleted = collection.delete_many({'_id': {'$in': [file['_id'] for file in files]}}).deleted_count
+        Content.release(Counter(file['content'] for file in files if file.get('content') is not None))
+
+        return deleted
+
+    @staticmethod
+    def decrypt_cached(values: list) -> list:
+        """ Decrypt encrypted fields one by one. Results are memoized by ciphertext, so listing of hot directories
+            doesn't pay for HMAC verification and decryption again
+
+        :param values: encrypted values
+        :return: decrypted values in the same order
         """
-        self.telegram_id = str(self.telegram_id)
-        self.telegram_id = CRYPTO.encrypt(self.telegram_id.encode())
+        results = []
+        for value in values:
+            value = bytes(value)
+            decrypted = DECRYPT_CACHE.get(value)
+            if decrypted is None:
+                decrypted = CRYPTO.decrypt(value)
+                DECRYPT_CACHE.put(value, decrypted)
+            results.append(decrypted)
+
+        return results
 
     @staticmethod
     def prepare_telegram_id(telegram_id: bytes) -> int:
@@ -131,26 +381,50 @@ class File(BaseFieldsMixin, AdditionalOperationsMixin, QueryMixin, Document):
         :param telegram_id: encrypted message id
         :return: decrypted message id
         """
-        return int(CRYPTO.decrypt(telegram_id))
+        return int(File.decrypt_cached([telegram_id])[0])
 
+    @staticmethod
+    def prepare_file_ids(file_ids: list) -> list:
+        """ Convert encrypted strings to telegram file ids, that could be used to send the files again
+
+        :param file_ids: encrypted file ids
+        :return: decrypted file ids in the same order
+        """
+        return [file_id.decode() for file_id in File.decrypt_cached(file_ids)]
 
+
+@cache_for_directory_post_delete.apply
+@cache_for_post_save.apply
 @datetime_for_pre_bulk_insert.apply
 @datetime_for_pre_save.apply
-class Directory(BaseFieldsMixin, AdditionalOperationsMixin, QueryMixin, Document):
+class Directory(LazyConnectionMixin, BaseFieldsMixin, AdditionalOperationsMixin, QueryMixin, Document):
     """ Representation of directory entity, that stores file ids
     """
     name = StringField(required=True, null=False)
     user_id = BinaryField(required=True, null=False)
+    search_key = StringField()
 
-    contains_directories = ListField(ReferenceField("self", reverse_delete_rule=PULL))
-    contains_files = ListField(ReferenceField(File, reverse_delete_rule=PULL))
+    parent = ReferenceField("self", null=True)
+    # names of directories from the root one to this one, joined by PATH_SEPARATOR
+    path = StringField()
+    last_file_position = LongField(default=0)
+    pending_delete = BooleanField()
+    # path of moved directory before the move, while its descendants may still keep it
+    pending_move = StringField()
 
     meta = {
         "db_alias": MONGO_ENGINE_ALIAS,
         "collections": "filesystem",
         "queryset_class": CustomQuerySet,
+        # directories, that are not migrated yet, still have <contains_files> and <contains_directories> lists
+        "strict": False,
         "indexes": [
-            {"fields": ('name', 'user_id'), 'unique': True}
+            # names are unique inside the parent directory, directories without path are not migrated yet
+            {"fields": ('user_id', 'path'), 'unique': True, 'partialFilterExpression': {'path': {'$type': 'string'}}},
+            {"fields": ('parent', 'name')},
+            {"fields": ('pending_delete',), 'sparse': True},
+            {"fields": ('pending_move',), 'sparse': True},
+            {"fields": ('user_id', 'search_key')}
         ]
     }
 
@@ -158,10 +432,56 @@ class Directory(BaseFieldsMixin, AdditionalOperationsMixin, QueryMixin, Document
         return f'Directory name: {self.name}'
 
     def clean(self):
-        """ Encrypt telegram_id field before saving
+        """ Encrypt telegram_id field, build search key and path before saving
         """
         if type(self.user_id) == int:
             self.user_id = Directory.encrypt_user_id(self.user_id)
+        self.search_key = self.name.lower()
+        if not self.path:
+            self.path = Directory.build_path(self.parent.path if self.parent else None, self.name)
+
+    @staticmethod
+    def is_valid_name(name: str) -> bool:
+        """ Check, that name could be a part of path
+
+        :param name: name of directory
+        :return: True if name is valid, otherwise False
+        """
+        return bool(name) and PATH_SEPARATOR not in name and name not in ('.', '..')
+
+    @staticmethod
+    def build_path(parent_path: str, name: str) -> str:
+        """ Build path of directory
+
+        :param parent_path: path of parent directory, None for the root one
+        :param name: name of directory
+        :return: path
+        """
+        return f'{parent_path}{PATH_SEPARATOR}{name}' if parent_path else name
+
+    @staticmethod
+    def resolve_path(current_path: str, target: str) -> str:
+        """ Resolve path, given by user, to the full one. Path, that starts with PATH_SEPARATOR, is counted from the
+            root directory, otherwise from the current one. '..' means parent directory
+
+        :param current_path: path of current directory
+        :param target: path, given by user, e.g. 'a/b', '../c' or '/a'
+        :return: full path or None, if it goes above the root directory
+        """
+        parts = current_path.split(PATH_SEPARATOR)
+        if target.startswith(PATH_SEPARATOR):
+            parts = parts[:1]
+        for name in target.split(PATH_SEPARATOR):
+            if name in ('', '.'):
+                continue
+            if name == '..':
+                if len(parts) == 1:
+                    return None
+                parts.pop()
+            else:
+                parts.append(name)
+
+        return PATH_SEPARATOR.join(parts)
 
     @staticmethod
     def encrypt_user_id(user_id: int) -> bytes:
@@ -181,32 +501,512 @@ class Directory(BaseFieldsMixin, AdditionalOperationsMixin, QueryMixin, Document
         """
         return int(base64.b64decode(user_id).decode())
 
+    @staticmethod
+    def lock_tree(encrypted_user_id: bytes):
+        """ Hold lease of the directory tree of a user, so its directories are not changed by other workers
+
+        :param encrypted_user_id: encrypted id of directories owner
+        :return: context manager
+        """
+        return Lease.hold(f'tree:{bytes(encrypted_user_id).decode()}')
+
+    @staticmethod
+    def cache_key(encrypted_user_id: bytes, path: str) -> tuple:
+        """ Build key of directory in DIRECTORY_CACHE
+
+        :param encrypted_user_id: encrypted id of directory owner
+        :param path: path of directory
+        :return: cache key
+        """
+        # drivers could return bson Binary, that is equal to bytes, but has another hash
+        return bytes(encrypted_user_id), path
+
+    @staticmethod
+    def referenced_id(document: object, field_name: str):
+        """ Get id of document, referenced in field, without dereferencing it
+
+        :param document: model instance
+        :param field_name: name of reference field
+        :return: referenced id or None, if field is empty
+        """
+        reference = document._data.get(field_name)
+        return getattr(reference, 'id', reference)
+
+    @classmethod
+    def get_by_path(cls, path: str, encrypted_user_id: bytes):
+        """ Get directory by its path with one indexed query, using DIRECTORY_CACHE to avoid DB round trip
+
+        :param path: path of directory
+        :param encrypted_user_id: encrypted id of directory owner
+        :return: Directory instance or None, if there is no such directory
+        """
+        key = cls.cache_key(encrypted_user_id, path)
+        directory = DIRECTORY_CACHE.get(key)
+        if directory is None:
+            version = DIRECTORY_CACHE.version
+            directory = cls.objects.get(path=path, user_id=encrypted_user_id, pending_delete__ne=True)
+            if directory:
+                DIRECTORY_CACHE.put(key, directory, version)
+
+        return directory
+
+    def get_child(self, name: str):
+        """ Get subdirectory by its name
+
+        :param name: name of subdirectory
+        :return: Directory instance or None, if there is no such subdirectory
+        """
+        if not self.is_valid_name(name):
+            return None
+
+        return Directory.get_by_path(self.build_path(self.path, name), self.user_id)
+
+    def update(self, **kwargs):
+        result = super().update(**kwargs)
+        DIRECTORY_CACHE.invalidate(self.cache_key(self.user_id, self.path))
+        return result
+
     def delete(self, signal_kwargs=None, **write_concern):
         def __delete_children(children):
             deque(
                 map(lambda instance: instance.delete(), children)
             )
 
-        __delete_children(self.contains_directories)
-        __delete_children(self.contains_files)
+        __delete_children(Directory.objects(parent=self))
+        File.delete_releasing({'directory': self.id})
         super().delete(signal_kwargs, **write_concern)
 
-    def has_subdirectory(self, name: str, encrypted_user_id: bytes) -> bool:
-        """ Check that Directory with name <name> exists and is subdirectory of current directory
+    def delete_subtree(self, batch_size: int = BULK_DELETE_BATCH_SIZE) -> dict:
+        """ Delete directory with all its subdirectories and files using one server-side traversal and batched
+            delete_many calls instead of recursive per-document deletes.
+            Directory is marked as pending delete first, so it is hidden from its parent. Directories are removed
+            from the deepest level up, so every remaining one is still reachable from the marked directory and
+            interrupted deletion could be resumed by calling this method again (see resume_pending_deletes()).
 
-        :param name: instance of possible subdirectory
-        :param encrypted_user_id:
-        :return: True if <name> is subdirectory, otherwise False
+        :param batch_size: amount of records, removed per one delete_many call
+        :return: amount of deleted directories and files
         """
-        if Directory.exists(name, encrypted_user_id):
-            testing_subdirectory = Directory.objects.get(name=name, user_id=encrypted_user_id)
-            return testing_subdirectory in self.contains_directories
-        else:
-            return False
+        collection = Directory._get_collection()
+        deleted = {'directories': 0, 'files': 0}
+
+        marked = collection.find_one_and_update(
+            {'_id': self.id},
+            {'$set': {'pending_delete': True}},
+            projection={'contains_files': 1}
+        )
+        DIRECTORY_CACHE.invalidate_where(lambda key, directory: key[0] == self.user_id)
+        SEARCH_CACHE.invalidate(bytes(self.user_id))
+        if marked is None:
+            return deleted
+
+        # subdirectories are found by indexed parent pointers, the directory itself is the level above them
+        subtree = collection.aggregate([
+            {'$match': {'_id': self.id}},
+            {'$graphLookup': {
+                'from': collection.name,
+                'startWith': '$_id',
+                'connectFromField': '_id',
+                'connectToField': 'parent',
+                'restrictSearchWithMatch': {'user_id': self.user_id},
+                'depthField': 'depth',
+                'as': 'subtree',
+            }},
+            {'$unwind': '$subtree'},
+            {'$project': {'_id': '$subtree._id', 'depth': '$subtree.depth', 'files': '$subtree.contains_files'}},
+        ])
+
+        directories = []
+        for directory in chain([{'_id': self.id, 'depth': -1, 'files': marked.get('contains_files')}], subtree):
+            directories.append((directory['depth'], directory['_id']))
+            # not migrated directories still keep ids of their files in <contains_files>
+            legacy_files = directory.get('files') or []
+            for start in range(0, len(legacy_files), batch_size):
+                batch = legacy_files[start:start + batch_size]
+                deleted['files'] += File.delete_releasing({'_id': {'$in': batch}})
+
+        for start in range(0, len(directories), batch_size):
+            batch = [directory_id for _, directory_id in directories[start:start + batch_size]]
+            deleted['files'] += File.delete_releasing({'directory': {'$in': batch}})
+
+        directories = [directory_id for _, directory_id in sorted(directories, key=lambda item: -item[0])]
+        for start in range(0, len(directories), batch_size):
+            batch = directories[start:start + batch_size]
+            deleted['directories'] += collection.delete_many({'_id': {'$in': batch}}).deleted_count
+
+        return deleted
 
     @classmethod
-    def exists(cls, name: str, encrypted_user_id: bytes) -> bool:
-        if cls.objects.get(name=name, user_id=encrypted_user_id):
+    def resume_pending_deletes(cls, batch_size: int = BULK_DELETE_BATCH_SIZE) -> dict:
+        """ Finish subtree deletions, that were interrupted
+
+        :param batch_size: amount of records, removed per one delete_many call
+        :return: amount of deleted directories and files
+        """
+        deleted = {'directories': 0, 'files': 0}
+        for directory in cls.objects(pending_delete=True):
+            try:
+                with cls.lock_tree(directory.user_id):
+                    for key, amount in directory.delete_subtree(batch_size).items():
+                        deleted[key] += amount
+            except LeaseBusyError:
+                # the tree is changed by another worker, the deletion is resumed by the next call
+                continue
+
+        return deleted
+
+    @classmethod
+    def attach_files(cls, path: str, encrypted_user_id: bytes, files: list) -> list:
+        """ Save batch of files (or a single one) as the last ones in directory with two server calls. Upload order
+            positions are reserved with atomic increment of directory counter, that also finds the directory by
+            path, so concurrent uploads get distinct positions, then files are inserted with one bulk insert.
+            If some of files are already stored, the rest are saved one by one
+
+        :param path: path of directory
+        :param encrypted_user_id: encrypted id of directory owner
+        :param files: File instances to save
+        :return: files, that were saved
+        :raises DoesNotExist: if directory doesn't exist or is being deleted
+        """
+        directory = cls._get_collection().find_one_and_update(
+            {'path': path, 'user_id': Binary(encrypted_user_id), 'pending_delete': {'$ne': True}},
+            {'$inc': {'last_file_position': len(files)}},
+            projection={'last_file_position': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if directory is None:
+            raise DoesNotExist(f"Directory '{path}' doesn't exist")
+
+        first_position = directory['last_file_position'] - len(files) + 1
+        for position, file in enumerate(files, start=first_position):
+            file.directory = directory['_id']
+            file.position = position
+            file.user_id = encrypted_user_id
+            # bulk insert doesn't clean and validate documents
+            file.validate()
+
+        try:
+            File.objects.insert(files, load_bulk=False)
+            saved = files
+        except (NotUniqueError, BulkInsertError):
+            # ordered insert stops on the first stored file, files before it are inserted at reserved positions
+            inserted = set(File.objects(
+                directory=directory['_id'], position__gte=first_position, position__lt=first_position + len(files)
+            ).scalar('position'))
+            saved = []
+            for file in files:
+                if file.position in inserted:
+                    saved.append(file)
+                    continue
+                try:
+                    saved.append(file.save())
+                except NotUniqueError:
+                    continue
+
+        named = [file for file in saved if file.search_key]
+        if named:
+            # cached search index of user gets new names instead of being built again
+            SEARCH_CACHE.update(bytes(encrypted_user_id), lambda index: index.add_files(named))
+        return saved
+
+    @classmethod
+    def create_child(cls, parent_path: str, name: str, encrypted_user_id: bytes):
+        """ Create directory inside the parent one. Parent is usually taken from DIRECTORY_CACHE, so creation takes
+            one insert, that is rejected by unique index, if the path is already taken
+
+        :param parent_path: path of parent directory
+        :param name: name of new directory
+        :param encrypted_user_id: encrypted id of directories owner
+        :return: new Directory instance or None, if directory with given name already exists in the parent
+        :raises DoesNotExist: if parent directory doesn't exist or is being deleted
+        """
+        parent = cls.get_by_path(parent_path, encrypted_user_id)
+        if parent is None:
+            raise DoesNotExist(f"Directory '{parent_path}' doesn't exist")
+
+        directory = cls(name=name, user_id=encrypted_user_id, parent=parent)
+        directory.validate()
+        BaseFieldsMixin.add_datetime_fields(directory)
+        try:
+            directory.id = cls._get_collection().insert_one(directory.to_mongo()).inserted_id
+        except DuplicateKeyError:
+            return None
+
+        SEARCH_CACHE.update(bytes(encrypted_user_id), lambda index: index.add_directory(directory))
+        return directory
+
+    def relocate(self, parent, name: str) -> int:
+        """ Move directory with its whole subtree to another parent and/or rename it. Descendants are not touched one
+            by one: the directory is updated first, that fails on unique index, if the new path is taken, then one
+            pipeline update_many replaces path prefix of all descendants on the server (MongoDB 4.2+).
+            Directory keeps its old path in <pending_move> until descendants are moved, so interrupted move could be
+            finished by finish_move() (see resume_pending_moves())
+
+        :param parent: new parent Directory instance
+        :param name: new name of directory
+        :return: amount of moved descendants
+        :raises NotUniqueError: if directory with the new path already exists
+        :raises ValueError: if directory is moved inside its own subtree
+        """
+        old_path = self.path
+        new_path = self.build_path(parent.path, name)
+        if parent.id == self.id or parent.path.startswith(f'{old_path}{PATH_SEPARATOR}'):
+            raise ValueError(f"Directory '{old_path}' can't be moved inside itself")
+
+        if self.pending_move:
+            # descendants have to get the current path of directory before it is moved again
+            self.finish_move()
+
+        collection = Directory._get_collection()
+        try:
+            collection.update_one({'_id': self.id}, {'$set': {
+                'parent': parent.id,
+                'name': name,
+                'search_key': name.lower(),
+                'path': new_path,
+                'pending_move': old_path,
+                'updated': datetime.utcnow(),
+            }})
+        except DuplicateKeyError:
+            raise NotUniqueError(f"Directory '{new_path}' already exists")
+
+        moved = self.__move_descendants(old_path, new_path, {})
+        collection.update_one({'_id': self.id}, {'$unset': {'pending_move': ''}})
+
+        DIRECTORY_CACHE.invalidate_where(lambda key, directory: key[0] == bytes(self.user_id))
+        SEARCH_CACHE.invalidate(bytes(self.user_id))
+        self.parent, self.name, self.path = parent, name, new_path
+        return moved
+
+    def finish_move(self, batch_size: int = BULK_DELETE_BATCH_SIZE) -> int:
+        """ Replace path prefix of descendants, that still keep the path of directory before interrupted move.
+            Descendants are found by parent pointers, so directories, created at the old path after the move, are
+            not touched
+
+        :param batch_size: amount of descendants, updated per one update_many call
+        :return: amount of moved descendants
+        """
+        collection = Directory._get_collection()
+        subtree = collection.aggregate([
+            {'$match': {'_id': self.id}},
+            {'$graphLookup': {
+                'from': collection.name,
+                'startWith': '$_id',
+                'connectFromField': '_id',
+                'connectToField': 'parent',
+                'restrictSearchWithMatch': {'user_id': self.user_id},
+                'as': 'subtree',
+            }},
+            {'$unwind': '$subtree'},
+            {'$project': {'_id': '$subtree._id'}},
+        ])
+        descendants = [directory['_id'] for directory in subtree]
+
+        moved = 0
+        for start in range(0, len(descendants), batch_size):
+            batch = descendants[start:start + batch_size]
+            moved += self.__move_descendants(self.pending_move, self.path, {'_id': {'$in': batch}})
+        collection.update_one({'_id': self.id}, {'$unset': {'pending_move': ''}})
+
+        DIRECTORY_CACHE.invalidate_where(lambda key, directory: key[0] == bytes(self.user_id))
+        SEARCH_CACHE.invalidate(bytes(self.user_id))
+        self.pending_move = None
+        return moved
+
+    def __move_descendants(self, old_path: str, new_path: str, descendants_filter: dict) -> int:
+        """ Replace path prefix of descendants with one pipeline update_many
+
+        :param old_path: path of directory before the move
+        :param new_path: path of directory after the move
+        :param descendants_filter: raw query, that narrows updated directories
+        :return: amount of moved descendants
+        """
+        return Directory._get_collection().update_many(
+            dict(
+                descendants_filter,
+                user_id=Binary(self.user_id),
+                path={'$regex': f'^{re.escape(old_path + PATH_SEPARATOR)}'}
+            ),
+            [{'$set': {'path': {'$concat': [
+                new_path,
+                {'$substrCP': ['$path', len(old_path), {'$strLenCP': '$path'}]}
+            ]}}}]
+        ).modified_count
+
+    @classmethod
+    def resume_pending_moves(cls) -> int:
+        """ Finish directory moves, that were interrupted
+
+        :return: amount of moved descendants
+        """
+        moved = 0
+        for directory in cls.objects(pending_move__ne=None):
+            try:
+                with cls.lock_tree(directory.user_id):
+                    # the move could be finished by relocate(), while the lease was taken
+                    directory.reload()
+                    if directory.pending_move:
+                        moved += directory.finish_move()
+            except LeaseBusyError:
+                # the tree is changed by another worker, the move is resumed by the next call
+                continue
+            except DoesNotExist:
+                # the directory is deleted together with its subtree
+                continue
+
+        return moved
+
+    def get_files_page(self, after: int, limit: int) -> list:
+        """ Get page of files, stored in directory, using keyset pagination by indexed upload order position
+
+        :param after: position of the last file of previous page, 0 for the first page
+        :param limit: max amount of files to return
+        :return: list of File instances in upload order
+        """
+        return list(File.objects(directory=self, position__gt=after).order_by('position').limit(limit))
+
+    def get_parent(self):
+        """ Get parent directory by indexed parent pointer. Directories, created before parent pointers were
+            introduced, fall back to lookup by <contains_directories> and get their pointer backfilled
+
+        :return: parent Directory instance or None, if directory has no parent
+        """
+        parent_id = self.referenced_id(self, 'parent')
+        if parent_id:
+            return Directory.objects.get(id=parent_id)
+        # directories with path are migrated, so only the root ones have no parent pointer
+        if self.path or self.name == ROOT_DIRECTORY:
+            return None
+
+        parent = Directory.objects.get(__raw__={'contains_directories': self.id}, user_id=self.user_id)
+        if parent:
+            Directory.objects(id=self.id).update(set__parent=parent)
+            DIRECTORY_CACHE.invalidate(self.cache_key(self.user_id, self.path))
+
+        return parent
+
+    def get_subdirectory_names(self) -> list:
+        """ Get names of subdirectories with one projected query by indexed parent pointer
+
+        :return: sorted list of names
+        """
+        return list(Directory.objects(parent=self, pending_delete__ne=True).order_by('name').scalar('name'))
+
+    @staticmethod
+    def get_subdirectories_page(parent_id, encrypted_user_id: bytes, after: str = None, before: str = None,
+                                limit: int = None) -> list:
+        """ Get page of subdirectories using keyset pagination by indexed (parent, name) pair, so a page costs
+            the same however many subdirectories there are
+
+        :param parent_id: id of parent directory
+        :param encrypted_user_id: encrypted id of directories owner
+        :param after: name of the last subdirectory of previous page, None for the first page
+        :param before: name of the first subdirectory of next page to get the page before it
+        :param limit: max amount of subdirectories to return
+        :return: list of (id, name) tuples, sorted by name
+        """
+        query = Directory.objects(parent=parent_id, user_id=encrypted_user_id, pending_delete__ne=True)
+        if before is not None:
+            return list(query.filter(name__lt=before).order_by('-name').limit(limit).scalar('id', 'name'))[::-1]
+        if after is not None:
+            query = query.filter(name__gt=after)
+
+        return list(query.order_by('name').limit(limit).scalar('id', 'name'))
+
+    @staticmethod
+    def get_subdirectory(directory_id, parent_id, encrypted_user_id: bytes):
+        """ Get directory by id with one query, checking, that it is still a subdirectory of given parent
+
+        :param directory_id: id of directory
+        :param parent_id: id of parent directory
+        :param encrypted_user_id: encrypted id of directory owner
+        :return: Directory instance or None, if it is deleted or moved
+        """
+        return Directory.objects.get(
+            id=directory_id,
+            parent=parent_id,
+            user_id=encrypted_user_id,
+            pending_delete__ne=True
+        )
+
+
+class ChatState(LazyConnectionMixin, Document):
+    """ Persisted conversation state: chat_data or user_data of one chat or user
+    """
+    kind = StringField(required=True, choices=('chat', 'user'))
+    key = LongField(required=True)
+    data = DictField()
+
+    meta = {
+        "db_alias": MONGO_ENGINE_ALIAS,
+        "indexes": [
+            {"fields": ('kind', 'key'), 'unique': True}
+        ]
+    }
+
+
+class Lease(LazyConnectionMixin, Document):
+    """ Exclusive lock of a resource, e.g. directory tree of a user, shared by all bot processes. Lease expires
+        after its time-to-live, so the one of crashed process doesn't block the resource forever
+    """
+    key = StringField(primary_key=True)
+    owner = StringField(required=True)
+    expires = DateTimeField(required=True)
+
+    meta = {
+        "db_alias": MONGO_ENGINE_ALIAS,
+    }
+
+    @classmethod
+    def acquire(cls, key: str, owner: str, ttl: float) -> bool:
+        """ Take the lease with one atomic upsert. Free, expired or own lease is matched and taken over, while
+            upsert of a lease, held by another owner, fails on unique _id
+
+        :param key: name of locked resource
+        :param owner: unique id of lease holder
+        :param ttl: seconds, the lease is held for
+        :return: True if the lease is taken, otherwise False
+        """
+        now = datetime.utcnow()
+        try:
+            cls._get_collection().find_one_and_update(
+                {'_id': key, '$or': [{'expires': {'$lte': now}}, {'owner': owner}]},
+                {'$set': {'owner': owner, 'expires': now + timedelta(seconds=ttl)}},
+                upsert=True
+            )
             return True
+        except DuplicateKeyError:
+            return False
+
+    @classmethod
+    def release(cls, key: str, owner: str):
+        cls._get_collection().delete_one({'_id': key, 'owner': owner})
 
-        return False
+    @classmethod
+    @contextmanager
+    def hold(cls, key: str, ttl: float = LEASE_TTL, wait: float = LEASE_WAIT):
+        """ Hold the lease while the block runs, waiting for it with exponential backoff, if it is busy. Long blocks
+            renew the lease with the function, that the context manager gives
+
+        :param key: name of locked resource
+        :param ttl: seconds, the lease is held for, if the holder doesn't release it
+        :param wait: max seconds to wait for the lease
+        :return: context manager, that gives function to renew the lease for another <ttl> seconds
+        :raises LeaseBusyError: if the lease is not released in time
+        """
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + wait
+        delay = 0.01
+        while not cls.acquire(key, owner, ttl):
+            if time.monotonic() >= deadline:
+                raise LeaseBusyError(f'Lease {key} is held by another worker')
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+        def renew():
+            if not cls.acquire(key, owner, ttl):
+                raise LeaseBusyError(f'Lease {key} is taken over by another worker')
+
+        try:
+            yield renew
+        finally:
+            cls.release(key, owner)
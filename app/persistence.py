@@ -0,0 +1,143 @@
+import copy
+from collections import defaultdict
+from threading import Thread, Event, Lock
+from pymongo import UpdateOne
+from telegram.ext import BasePersistence
+from app import logger
+from app.models import ChatState
+
+KINDS = ('chat', 'user')
+
+
+class LazyState(defaultdict):
+    """ chat_data or user_data, that loads stored entry of a chat or user, when it is used for the first time, so
+        a process doesn't read state of chats, that it doesn't serve
+    """
+    def __init__(self, kind: str, snapshots: dict):
+        super().__init__(dict)
+        self.kind = kind
+        self.snapshots = snapshots
+
+    def __missing__(self, key):
+        state = ChatState._get_collection().find_one({'kind': self.kind, 'key': key}, {'data': 1})
+        data = self[key] = state['data'] if state else {}
+        self.snapshots[key] = copy.deepcopy(data)
+        return data
+
+
+class MongoPersistence(BasePersistence):
+    """ Keeps chat_data and user_data in MongoDB, so conversation state survives restarts.
+        Data is written behind: dispatcher keeps working with in-memory dictionaries, and a background thread
+        periodically writes entries, that were changed since the last flush, with one bulk upsert. Many navigation
+        changes of a chat between two flushes are coalesced to one write. Only entries of chats and users, that
+        had updates since the last flush, are compared with their written state
+    """
+    def __init__(self, flush_interval: float, batch_size: int = 500):
+        super().__init__(store_user_data=True, store_chat_data=True, store_bot_data=False)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.flushed = 0
+        self._snapshots = {kind: {} for kind in KINDS}
+        self._data = {kind: LazyState(kind, self._snapshots[kind]) for kind in KINDS}
+        self._dirty = {kind: set() for kind in KINDS}
+        self._dirty_lock = Lock()
+        self._flush_lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._run, name='persistence_flusher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop background writes and flush the remaining changes
+        """
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+    def get_chat_data(self) -> defaultdict:
+        return self._data['chat']
+
+    def get_user_data(self) -> defaultdict:
+        return self._data['user']
+
+    def get_bot_data(self) -> dict:
+        return {}
+
+    def get_conversations(self, name: str) -> dict:
+        return {}
+
+    def update_conversation(self, name: str, key: tuple, new_state):
+        pass
+
+    def update_chat_data(self, chat_id: int, data: dict):
+        self._update('chat', chat_id, data)
+
+    def update_user_data(self, user_id: int, data: dict):
+        self._update('user', user_id, data)
+
+    def update_bot_data(self, data: dict):
+        pass
+
+    def flush(self):
+        """ Write all entries, changed since the last flush, with bulk upserts
+        """
+        with self._flush_lock:
+            for kind in KINDS:
+                changes = self._changes(kind)
+                for start in range(0, len(changes), self.batch_size):
+                    batch = changes[start:start + self.batch_size]
+                    try:
+                        ChatState._get_collection().bulk_write([
+                            UpdateOne({'kind': kind, 'key': key}, {'$set': {'data': data}}, upsert=True)
+                            for key, data in batch
+                        ], ordered=False)
+                    except Exception:
+                        # entries, that weren't written, are written by the next flush
+                        with self._dirty_lock:
+                            self._dirty[kind].update(key for key, _ in changes[start:])
+                        raise
+                    self._snapshots[kind].update(batch)
+                    self.flushed += len(batch)
+
+    def stats(self) -> dict:
+        return {
+            'chats': len(self._data['chat']),
+            'users': len(self._data['user']),
+            'flushed': self.flushed,
+        }
+
+    def _update(self, kind: str, key: int, data: dict):
+        """ Mark entry as changed. It is called after every update, that the chat or user had
+        """
+        self._data[kind][key] = data
+        with self._dirty_lock:
+            self._dirty[kind].add(key)
+
+    def _changes(self, kind: str) -> list:
+        """ Get copies of entries, that were marked as changed and differ from their last written state
+
+        :param kind: 'chat' or 'user'
+        :return: list of (key, data) pairs
+        """
+        with self._dirty_lock:
+            keys, self._dirty[kind] = self._dirty[kind], set()
+
+        changes = []
+        for key in keys:
+            data = self._data[kind][key]
+            # dict() copy is atomic, while handler threads could change the data during deep copy
+            data = copy.deepcopy(dict(data))
+            if data != self._snapshots[kind].get(key, {}):
+                changes.append((key, data))
+
+        return changes
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as error:
+                logger.error(f'Failed to flush conversation state: {error}')
@@ -0,0 +1,151 @@
+import re
+import heapq
+from bisect import bisect_left, bisect_right
+from threading import Lock
+from bson import Binary
+from app.cache import LRUCache
+from app.models import Directory, File, SEARCH_CACHE
+from app.config import SEARCH_CACHE_SIZE, SEARCH_INDEX_MAX_SIZE, SEARCH_LARGE_USER_TTL, SEARCH_HOT_WINDOW
+
+# users, who searched in the last SEARCH_HOT_WINDOW seconds, by encrypted user id. Index is built on their next search
+SEARCH_TIMES = LRUCache(SEARCH_CACHE_SIZE, SEARCH_HOT_WINDOW)
+# users, that have more than SEARCH_INDEX_MAX_SIZE names, so they aren't counted again after every change
+LARGE_USERS = LRUCache(SEARCH_CACHE_SIZE, SEARCH_LARGE_USER_TTL)
+
+
+class SearchIndex:
+    """ Sorted list of search keys of user names. Names, that start with a prefix, are found by binary search
+        and follow each other in lexicographical order. Names, that user adds, are inserted in place
+    """
+    def __init__(self, hits: list):
+        """
+        :param hits: (search key, label, id of directory to jump to) tuples, sorted by search key
+        """
+        self._keys = [hit[0] for hit in hits]
+        self._hits = hits
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._hits)
+
+    def add_files(self, files: list) -> int:
+        """ Add names of saved files
+
+        :param files: File instances with search key
+        :return: amount of names in the index
+        """
+        # directory of file is a reference or its id
+        return self.__add(
+            (file.search_key, file.name, getattr(file.directory, 'id', file.directory)) for file in files
+        )
+
+    def add_directory(self, directory) -> int:
+        """ Add name of created directory
+
+        :param directory: Directory instance
+        :return: amount of names in the index
+        """
+        return self.__add([(directory.search_key, f'{directory.name}/', directory.id)])
+
+    def find(self, prefix: str, limit: int) -> list:
+        """ Find names, whose keys start with prefix
+
+        :param prefix: prefix of search key
+        :param limit: max amount of names to return
+        :return: (search key, label, id of directory to jump to) tuples in lexicographical order of keys
+        """
+        with self._lock:
+            start = bisect_left(self._keys, prefix)
+            hits = []
+            for hit in self._hits[start:start + limit]:
+                if not hit[0].startswith(prefix):
+                    break
+                hits.append(hit)
+
+            return hits
+
+    def __add(self, hits) -> int:
+        with self._lock:
+            for hit in hits:
+                # names with equal keys keep the order they were added in
+                position = bisect_right(self._keys, hit[0])
+                self._keys.insert(position, hit[0])
+                self._hits.insert(position, hit)
+
+            return len(self._hits)
+
+
+def _directory_hit(directory: dict) -> tuple:
+    return directory['search_key'], f"{directory['name']}/", directory['_id']
+
+
+def _file_hit(file: dict) -> tuple:
+    return file['search_key'], file['name'], file['directory']
+
+
+def _query(collection, encrypted_user_id: bytes, prefix: str = None, limit: int = 0):
+    # user ids are stored as BSON binary by mongoengine
+    query = {'user_id': Binary(encrypted_user_id), 'search_key': {'$ne': None}}
+    if prefix is not None:
+        # anchored case sensitive regex is a range scan of (user_id, search_key) index
+        query['search_key'] = {'$regex': f'^{re.escape(prefix)}'}
+    if collection.name == Directory._get_collection_name():
+        query['pending_delete'] = {'$ne': True}
+
+    return collection.find(
+        query, {'name': 1, 'search_key': 1, 'directory': 1}, sort=[('search_key', 1)], limit=limit
+    )
+
+
+def _merged_hits(encrypted_user_id: bytes, prefix: str = None, limit: int = 0):
+    """ Get names of directories and files of user, sorted by search key, with two indexed queries
+    """
+    return heapq.merge(
+        map(_directory_hit, _query(Directory._get_collection(), encrypted_user_id, prefix, limit)),
+        map(_file_hit, _query(File._get_collection(), encrypted_user_id, prefix, limit)),
+        key=lambda hit: hit[0]
+    )
+
+
+def build_index(encrypted_user_id: bytes):
+    """ Build search index of names of all directories and files of user
+
+    :param encrypted_user_id: encrypted id of user
+    :return: SearchIndex or None, if user has more than SEARCH_INDEX_MAX_SIZE names
+    """
+    hits = []
+    for hit in _merged_hits(encrypted_user_id, limit=SEARCH_INDEX_MAX_SIZE + 1):
+        hits.append(hit)
+        if len(hits) > SEARCH_INDEX_MAX_SIZE:
+            return None
+
+    return SearchIndex(hits)
+
+
+def find(encrypted_user_id: bytes, prefix: str, offset: int, limit: int) -> list:
+    """ Find directories and files of user, whose names start with prefix, ignoring case. Names of users, who search
+        again in SEARCH_HOT_WINDOW, are searched in cached index, names of the rest are searched by indexed prefix
+        query
+
+    :param encrypted_user_id: encrypted id of user
+    :param prefix: prefix of name
+    :param offset: amount of hits to skip
+    :param limit: max amount of hits to return
+    :return: list of (search key, label, id of directory to jump to) tuples, ordered by name
+    """
+    prefix = prefix.lower()
+    cache_key = bytes(encrypted_user_id)
+    index = SEARCH_CACHE.get(cache_key)
+    if index is None and SEARCH_TIMES.get(cache_key) and not LARGE_USERS.get(cache_key):
+        version = SEARCH_CACHE.version
+        index = build_index(encrypted_user_id)
+        if index is None:
+            LARGE_USERS.put(cache_key, True)
+        else:
+            SEARCH_CACHE.put(cache_key, index, version, weight=len(index))
+    SEARCH_TIMES.put(cache_key, True)
+
+    if index is not None:
+        return index.find(prefix, offset + limit)[offset:]
+
+    return list(_merged_hits(encrypted_user_id, prefix, offset + limit))[offset:offset + limit]
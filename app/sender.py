@@ -0,0 +1,373 @@
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Thread, Condition
+from telegram import Bot
+from telegram.error import RetryAfter, BadRequest
+from app import logger
+from app.metrics import METRICS, add_to_trace
+
+MAX_MESSAGE_LENGTH = 4096
+
+
+class TokenBucket:
+    """ Token bucket rate limiter. It is not thread-safe by itself and is guarded by SendScheduler lock
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def delay(self, now: float, cost: float = 1) -> float:
+        """ Get amount of seconds to wait until bucket has enough tokens
+
+        :param now: current monotonic time
+        :param cost: amount of tokens, that is required
+        :return: 0 if tokens are available now, otherwise seconds to wait
+        """
+        self.refill(now)
+        cost = min(cost, self.capacity)
+        if self.tokens >= cost:
+            return 0.0
+
+        return (cost - self.tokens) / self.rate
+
+    def consume(self, now: float, cost: float = 1):
+        self.refill(now)
+        self.tokens -= min(cost, self.capacity)
+
+
+class SendJob:
+    """ Outgoing Bot API call, waiting in SendScheduler queue
+    """
+    def __init__(self, chat_id, method, args: tuple, kwargs: dict, cost: int = 1, merge_key=None, ignore=None):
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.cost = cost
+        self.merge_key = merge_key
+        self.ignore = ignore
+        self.futures = [Future()]
+        self.enqueued = time.monotonic()
+
+    def merge(self, job) -> bool:
+        """ Append text of another plain text message to the chat to this one, so both are sent as one message.
+            Every text is kept, even if it repeats the previous one
+
+        :param job: SendJob to merge into current one
+        :return: True if job was merged, otherwise False
+        """
+        if self.merge_key is None or job.merge_key != self.merge_key:
+            return False
+
+        chat_id, text = self.args
+        text = f'{text}\n{job.args[1]}'
+        if len(text) > MAX_MESSAGE_LENGTH:
+            return False
+
+        self.args = (chat_id, text)
+        self.futures.extend(job.futures)
+        return True
+
+
+class SendScheduler:
+    """ Central queue of outgoing Bot API calls. Calls are started in FIFO order per chat, limited by per-chat and
+        global token buckets, and are retried after the delay, requested by RetryAfter error, instead of being dropped
+    """
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int, concurrency: int,
+                 merge_messages: bool = True):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.concurrency = concurrency
+        self.merge_messages = merge_messages
+        self.sent = 0
+        self.merged = 0
+        self.retried = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._jobs = deque()
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._blocked_until = {}
+        self._busy_chats = set()
+        self._condition = Condition()
+        self._executor = None
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='sender')
+        self._thread = Thread(target=self._run, name='send_scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop scheduler after all queued calls are sent
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+
+        if self._thread:
+            self._thread.join()
+            self._executor.shutdown(wait=True)
+
+    def call(self, chat_id, method, args: tuple, kwargs: dict, cost: int = 1, merge_key=None, ignore=None):
+        """ Enqueue Bot API call without waiting for it, so rate limit of one chat doesn't hold the handler and
+            the worker thread, that other chats are handled by. Callers, that need the sent message, wait for
+            the future (see resolved()). Before the scheduler is started calls are made directly
+
+        :param chat_id: id of chat, that the call is addressed to
+        :param method: bound Bot method to call
+        :param args: positional arguments of the call
+        :param kwargs: keyword arguments of the call
+        :param cost: amount of messages, that the call sends
+        :param merge_key: calls with equal not None keys, queued one after another, are sent as one message
+        :param ignore: predicate of expected errors of the call, they are not logged and the result is None
+        :return: Future of Bot API call result or the result itself, if the scheduler is not running
+        """
+        started = time.perf_counter()
+        try:
+            if not self._running:
+                try:
+                    return method(*args, **kwargs)
+                except Exception as error:
+                    if ignore and ignore(error):
+                        return None
+                    raise
+
+            job = SendJob(chat_id, method, args, kwargs, cost, merge_key, ignore)
+            with self._condition:
+                self._jobs.append(job)
+                self._condition.notify()
+
+            return job.futures[0]
+        finally:
+            # time, that the handler spends on the call
+            add_to_trace('telegram', time.perf_counter() - started)
+
+    def stats(self) -> dict:
+        """ Get queue depth, throughput and wait time counters
+        """
+        with self._condition:
+            return {
+                'queue_depth': len(self._jobs),
+                'in_flight': len(self._busy_chats),
+                'sent': self.sent,
+                'merged': self.merged,
+                'retried': self.retried,
+                'failed': self.failed,
+                'wait_avg': round(self.wait_total / self.sent, 4) if self.sent else 0.0,
+                'wait_max': round(self.wait_max, 4),
+            }
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._prune_buckets()
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+
+        return bucket
+
+    def _prune_buckets(self):
+        """ Forget buckets of idle chats, they are full again and are equal to new ones
+        """
+        now = time.monotonic()
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity and chat_id not in self._busy_chats:
+                del self._chat_buckets[chat_id]
+                self._blocked_until.pop(chat_id, None)
+
+    def _select(self, now: float) -> tuple:
+        """ Find the first queued call, that could be started now. Calls of a chat are started one at a time and
+            in the order they were queued
+
+        :param now: current monotonic time
+        :return: selected job or None and amount of seconds to wait before the next attempt
+        """
+        if not self._jobs:
+            return None, None
+
+        global_delay = self._global_bucket.delay(now)
+        if global_delay > 0:
+            return None, global_delay
+
+        timeout = None
+        seen_chats = set()
+        for index, job in enumerate(self._jobs):
+            if job.chat_id in seen_chats:
+                continue
+            seen_chats.add(job.chat_id)
+            if job.chat_id in self._busy_chats:
+                continue
+
+            delay = max(
+                self._chat_bucket(job.chat_id).delay(now, job.cost),
+                self._blocked_until.get(job.chat_id, 0) - now
+            )
+            if delay > 0:
+                timeout = delay if timeout is None else min(timeout, delay)
+                continue
+
+            del self._jobs[index]
+            if self.merge_messages:
+                self._merge_following(job, index)
+            self._global_bucket.consume(now, job.cost)
+            self._chat_bucket(job.chat_id).consume(now, job.cost)
+            self._busy_chats.add(job.chat_id)
+            return job, None
+
+        return None, timeout
+
+    def _merge_following(self, job: SendJob, index: int):
+        """ Merge plain text messages, queued to the same chat right after the job, into the job
+        """
+        while index < len(self._jobs):
+            following = self._jobs[index]
+            if following.chat_id != job.chat_id:
+                index += 1
+                continue
+            if not job.merge(following):
+                return
+            del self._jobs[index]
+            self.merged += 1
+
+    def _run(self):
+        while True:
+            with self._condition:
+                job, timeout = self._select(time.monotonic())
+                if job is None:
+                    if not self._running and not self._jobs and not self._busy_chats:
+                        return
+                    self._condition.wait(timeout)
+                    continue
+
+            self._executor.submit(self._execute, job)
+
+    def _execute(self, job: SendJob):
+        started = time.monotonic()
+        try:
+            try:
+                result = job.method(*job.args, **job.kwargs)
+            finally:
+                METRICS.observe('telegram_api_seconds', {'method': job.method.__name__}, time.monotonic() - started)
+        except RetryAfter as retry_after:
+            logger.warning(f'Flood limit is reached for chat {job.chat_id}, retry in {retry_after.retry_after}s')
+            with self._condition:
+                self.retried += 1
+                self._blocked_until[job.chat_id] = time.monotonic() + retry_after.retry_after
+                self._jobs.appendleft(job)
+                self._busy_chats.discard(job.chat_id)
+                self._condition.notify()
+            return
+        except Exception as error:
+            if job.ignore and job.ignore(error):
+                for future in job.futures:
+                    future.set_result(None)
+            else:
+                # most of futures are not waited for, so the error is not raised anywhere else
+                logger.warning(f'{job.method.__name__} to chat {job.chat_id} failed: {error!r}')
+                with self._condition:
+                    self.failed += 1
+                for future in job.futures:
+                    future.set_exception(error)
+        else:
+            with self._condition:
+                wait = started - job.enqueued
+                self.sent += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+            for future in job.futures:
+                future.set_result(result)
+
+        # time from enqueueing of the call to its result, including time in the queue
+        METRICS.observe('telegram_call_seconds', {'method': job.method.__name__}, time.monotonic() - job.enqueued)
+
+        with self._condition:
+            self._busy_chats.discard(job.chat_id)
+            self._condition.notify()
+
+
+def resolved(result):
+    """ Wait for result of Bot call, that could be enqueued by SendScheduler
+
+    :param result: Future or result of Bot method
+    :return: result of Bot API call, e.g. sent Message
+    """
+    return result.result() if isinstance(result, Future) else result
+
+
+def ignore_bad_request(*messages: str):
+    """ Build predicate of expected BadRequest errors, e.g. of forwarding of a deleted message
+
+    :param messages: beginnings of error descriptions
+    :return: predicate for ignore argument of SendScheduler.call()
+    """
+    def predicate(error: Exception) -> bool:
+        return isinstance(error, BadRequest) and str(error).startswith(messages)
+
+    return predicate
+
+
+def scheduled(method_name: str, chat_id_position: int = 0):
+    """ Build Bot method, that sends the call through bot SendScheduler
+
+    :param method_name: name of Bot method
+    :param chat_id_position: position of chat_id argument, if it is passed as positional one
+    :return: method for ScheduledBot class, that takes ignore argument of SendScheduler.call() besides Bot ones
+    """
+    def method(self, *args, ignore=None, **kwargs):
+        chat_id = kwargs.get('chat_id', args[chat_id_position] if len(args) > chat_id_position else None)
+        return self.scheduler.call(
+            chat_id, getattr(super(ScheduledBot, self), method_name), args, kwargs, ignore=ignore
+        )
+
+    method.__name__ = method_name
+    return method
+
+
+class ScheduledBot(Bot):
+    """ Bot, that routes all outgoing messages through SendScheduler
+    """
+    def __init__(self, *args, scheduler: SendScheduler, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+
+    def send_message(self, chat_id, text, *args, ignore=None, **kwargs):
+        # only texts without any options are merged, so a message, that is edited later, is sent with an option,
+        # e.g. as a reply, to get a result of its own
+        merge_key = None
+        if not args and set(kwargs) <= {'disable_notification'} and ignore is None:
+            merge_key = (chat_id, kwargs.get('disable_notification'))
+
+        return self.scheduler.call(
+            chat_id, super().send_message, (chat_id, text) + args, kwargs, merge_key=merge_key, ignore=ignore
+        )
+
+    def send_media_group(self, chat_id, media, *args, ignore=None, **kwargs):
+        return self.scheduler.call(
+            chat_id, super().send_media_group, (chat_id, media) + args, kwargs, cost=len(media), ignore=ignore
+        )
+
+    forward_message = scheduled('forward_message')
+    send_photo = scheduled('send_photo')
+    send_document = scheduled('send_document')
+    send_video = scheduled('send_video')
+    send_audio = scheduled('send_audio')
+    send_voice = scheduled('send_voice')
+    edit_message_text = scheduled('edit_message_text', chat_id_position=1)
+    edit_message_reply_markup = scheduled('edit_message_reply_markup')
@@ -0,0 +1,80 @@
+import zlib
+import multiprocessing
+from telegram import Update
+from telegram.ext import TypeHandler, DispatcherHandlerStop
+from app import logger
+
+
+def shard_of(update, shards: int) -> int:
+    """ Get number of worker process of update user, so every update, that changes directory tree of the user, is
+        handled by one process. Updates without user, e.g. channel posts, go by chat id. CRC32 of the id is stable
+        across processes and restarts and isn't correlated with id modulo, that spreads updates between threads of
+        the process
+
+    :param update: Telegram update
+    :param shards: amount of worker processes
+    :return: number of worker process
+    """
+    if update.effective_user:
+        key = update.effective_user.id
+    elif update.effective_chat:
+        key = update.effective_chat.id
+    else:
+        key = 0
+
+    return zlib.crc32(str(key).encode()) % shards
+
+
+class ShardRouter:
+    """ Front of sharded bot. The process, that receives updates, forwards every one of them to the worker process
+        of its user before any other handler runs, so updates of a user are handled by one process in the order
+        they came, while different users are handled by all cores
+    """
+    def __init__(self, shards: int, queue_size: int, target):
+        """
+        :param shards: amount of worker processes
+        :param queue_size: max amount of updates, waiting in the queue of one process. Receiving of updates is
+            blocked, when the queue is full
+        :param target: function, that serves updates of a shard in worker process. It takes number of shard and
+            the queue of update dicts, None in the queue means stop
+        """
+        # worker processes don't inherit DB connections and threads of the front process
+        context = multiprocessing.get_context('spawn')
+        self.queues = [context.Queue(queue_size) for _ in range(shards)]
+        self.processes = [
+            context.Process(target=target, args=(number, queue), name=f'shard_{number}', daemon=True)
+            for number, queue in enumerate(self.queues)
+        ]
+        self.forwarded = [0] * shards
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def stop(self):
+        """ Stop worker processes after all forwarded updates are handled
+        """
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join()
+            if process.exitcode:
+                logger.error(f'Worker process {process.name} exited with code {process.exitcode}')
+
+    def register(self, dispatcher):
+        """ Forward all updates of dispatcher to worker processes
+        """
+        dispatcher.add_handler(TypeHandler(Update, self.forward), group=-1)
+
+    def forward(self, update, context):
+        number = shard_of(update, len(self.queues))
+        self.queues[number].put(update.to_dict())
+        self.forwarded[number] += 1
+        raise DispatcherHandlerStop()
+
+    def stats(self) -> dict:
+        return {
+            'forwarded': sum(self.forwarded),
+            'queue_depth': sum(queue.qsize() for queue in self.queues),
+            'alive': sum(process.is_alive() for process in self.processes),
+        }
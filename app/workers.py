@@ -0,0 +1,123 @@
+import time
+from queue import Queue
+from threading import Thread, Lock
+from telegram import Update
+from app import logger
+from app.metrics import METRICS
+
+
+class KeyedWorkerPool:
+    """ Pool of worker threads, that run update handlers out of dispatcher thread. Updates of the same chat are
+        always processed by the same worker, so they are handled one by one and in the order they came
+    """
+    def __init__(self, workers: int, dispatcher):
+        self.workers = workers
+        self.dispatcher = dispatcher
+        self._queues = [Queue() for _ in range(workers)]
+        self._threads = []
+        self._lock = Lock()
+        self.busy = 0
+        self.busy_seconds = 0.0
+        self.handled = 0
+
+    def start(self):
+        for number, queue in enumerate(self._queues):
+            thread = Thread(target=self._run, args=(queue,), name=f'handler_worker_{number}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """ Stop workers after all queued updates are processed
+        """
+        for queue in self._queues:
+            queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def queue_depth(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    def stats(self) -> dict:
+        """ Get queue depth, amount of busy workers and total time workers spent in handlers
+        """
+        with self._lock:
+            return {
+                'queue_depth': self.queue_depth(),
+                'max_queue_depth': max((queue.qsize() for queue in self._queues), default=0),
+                'busy': self.busy,
+                'busy_seconds': round(self.busy_seconds, 4),
+                'handled': self.handled,
+            }
+
+    def wrap(self, callback):
+        """ Make handler callback run in the pool instead of dispatcher thread
+
+        :param callback: handler callback, that takes update and context
+        :return: callback, that enqueues update to the worker of update chat
+        """
+        if self.workers <= 0:
+            return callback
+
+        def enqueue(update, context):
+            self._queues[hash(self.key_of(update)) % self.workers].put((callback, update, context, time.perf_counter()))
+
+        return enqueue
+
+    @staticmethod
+    def key_of(update):
+        """ Get key, that update is assigned to a worker by: id of its chat or user. Events, that bot puts to the
+            update queue itself, e.g. AlbumReady, are assigned by their chat_id
+        """
+        if getattr(update, 'effective_chat', None):
+            return update.effective_chat.id
+        if getattr(update, 'effective_user', None):
+            return update.effective_user.id
+
+        return getattr(update, 'chat_id', 0)
+
+    def handle(self, callback, update, context, enqueued: float):
+        """ Run handler callback in current worker
+
+        :param enqueued: time, when the update was put to the queue of the worker
+        """
+        started = time.perf_counter()
+        METRICS.observe('worker_queue_seconds', {}, started - enqueued)
+        with self._lock:
+            self.busy += 1
+        try:
+            callback(update, context)
+        except Exception as error:
+            try:
+                self.dispatcher.dispatch_error(update, error)
+            except Exception:
+                logger.exception('An uncaught error was raised while handling the error')
+        finally:
+            self.__persist(update)
+            with self._lock:
+                self.busy -= 1
+                self.busy_seconds += time.perf_counter() - started
+                self.handled += 1
+
+    def __persist(self, update):
+        """ Pass chat_data and user_data of the update to persistence again. Dispatcher passes them, when it has
+            enqueued the update, that is before the handler changes them
+        """
+        persistence = self.dispatcher.persistence
+        if persistence is None or not isinstance(update, Update):
+            return
+
+        if persistence.store_chat_data and update.effective_chat:
+            chat_id = update.effective_chat.id
+            persistence.update_chat_data(chat_id, self.dispatcher.chat_data[chat_id])
+        if persistence.store_user_data and update.effective_user:
+            user_id = update.effective_user.id
+            persistence.update_user_data(user_id, self.dispatcher.user_data[user_id])
+
+    def _run(self, queue: Queue):
+        while True:
+            task = queue.get()
+            if task is None:
+                return
+
+            self.handle(*task)
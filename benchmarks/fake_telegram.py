@@ -0,0 +1,221 @@
+""" Local fake of Telegram Bot API server. It records every call of the bot, answers with minimal valid objects and
+    delivers injected updates either through getUpdates long polling or by posting them to the registered webhook
+"""
+import json
+import time
+import itertools
+import threading
+import urllib.request
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+POLL_TIMEOUT = 0.5
+
+
+class FakeTelegram:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0):
+        """
+        :param host: interface to listen
+        :param port: port to listen, 0 to pick a free one
+        :param latency: seconds to wait before answering each Bot API call
+        """
+        self.latency = latency
+        self.calls = []
+        self.webhook_url = None
+        self._updates = deque()
+        self._condition = threading.Condition()
+        self._ids = itertools.count(1)
+        self._server = ThreadingHTTPServer((host, port), self._build_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake_telegram', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def push_update(self, update: dict):
+        """ Deliver update to the bot: post it to webhook, if one is set, otherwise return it with getUpdates
+        """
+        if self.webhook_url:
+            request = urllib.request.Request(
+                self.webhook_url,
+                data=json.dumps(update).encode(),
+                headers={'Content-Type': 'application/json'}
+            )
+            urllib.request.urlopen(request).read()
+        else:
+            with self._condition:
+                self._updates.append(update)
+                self._condition.notify_all()
+
+    def calls_of(self, *methods: str) -> list:
+        with self._condition:
+            return [call for call in self.calls if call['method'] in methods]
+
+    def wait_for_calls(self, amount: int, *methods: str, timeout: float = 60) -> bool:
+        """ Wait until bot made given amount of calls of given methods
+
+        :return: True if calls were made before timeout, otherwise False
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while len([call for call in self.calls if call['method'] in methods]) < amount:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+
+            return True
+
+    def _message(self, payload: dict, **fields) -> dict:
+        message = {
+            'message_id': next(self._ids),
+            'date': int(time.time()),
+            'chat': {'id': int(payload.get('chat_id') or 0), 'type': 'private'},
+        }
+        message.update(fields)
+        return message
+
+    def _answer(self, method: str, payload: dict):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+        if method == 'getUpdates':
+            with self._condition:
+                if not self._updates:
+                    self._condition.wait(min(float(payload.get('timeout') or 0), POLL_TIMEOUT))
+                updates = list(self._updates)
+                self._updates.clear()
+            return updates
+        if method == 'setWebhook':
+            self.webhook_url = payload.get('url') or None
+            return True
+        if method == 'deleteWebhook':
+            self.webhook_url = None
+            return True
+        if method == 'sendMessage':
+            return self._message(payload, text=payload.get('text', ''))
+        if method == 'sendMediaGroup':
+            media = payload.get('media') or []
+            if isinstance(media, str):
+                media = json.loads(media)
+            return [self._message(payload, photo=[]) for _ in media]
+        if method in ('forwardMessage', 'sendPhoto', 'sendDocument', 'sendVideo', 'sendAudio', 'sendVoice'):
+            return self._message(payload)
+        if method in ('editMessageText', 'editMessageReplyMarkup'):
+            return self._message(payload, text=payload.get('text', ''))
+        if method == 'getFile':
+            return {'file_id': payload.get('file_id'), 'file_path': f"files/{payload.get('file_id')}"}
+
+        return True
+
+    def _build_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _payload(self) -> dict:
+                payload = dict(parse_qsl(urlparse(self.path).query))
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                if body and 'json' in (self.headers.get('Content-Type') or ''):
+                    payload.update(json.loads(body))
+                return payload
+
+            def _handle(self):
+                method = urlparse(self.path).path.rsplit('/', 1)[-1]
+                payload = self._payload()
+                if fake.latency:
+                    time.sleep(fake.latency)
+
+                result = fake._answer(method, payload)
+                if method not in ('getUpdates', 'getMe'):
+                    with fake._condition:
+                        fake.calls.append({'method': method, 'payload': payload, 'time': time.monotonic()})
+                        fake._condition.notify_all()
+
+                body = json.dumps({'ok': True, 'result': result}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = _handle
+            do_POST = _handle
+
+        return Handler
+
+
+def user(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+
+
+def command_update(update_id: int, user_id: int, text: str) -> dict:
+    """ Build update with bot command message from private chat with user
+    """
+    command = text.split(' ', 1)[0]
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': user(user_id),
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+        }
+    }
+
+
+def callback_update(update_id: int, user_id: int, data: str) -> dict:
+    """ Build update with inline keyboard button press
+    """
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': 'keyboard',
+            },
+        }
+    }
+
+
+def photo_update(update_id: int, user_id: int, file_number: int, media_group_id: str = None) -> dict:
+    """ Build update with photo message, that is a part of album, if media group id is given
+    """
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': user(user_id),
+        'photo': [{
+            'file_id': f'photo_{file_number}',
+            'file_unique_id': f'unique_{file_number}',
+            'width': 1280,
+            'height': 960,
+            'file_size': 100000,
+        }],
+    }
+    if media_group_id:
+        message['media_group_id'] = media_group_id
+
+    return {'update_id': update_id, 'message': message}
@@ -0,0 +1,289 @@
+""" Synthetic load of the dispatcher, set up by run.py. Realistic updates of simulated users (commands, keyboard
+    callbacks and photo albums) are injected into the dispatcher update queue at given rate, handlers run in the
+    worker pool against seeded database and replies go to local fake Telegram server:
+
+    python -m benchmarks.load_generator --users 1000 --rate 300 --updates 5000
+    python -m benchmarks.load_generator --backend mongod --users 1000 --rate 300 --updates 5000 --workers 8
+    python -m benchmarks.load_generator --backend mongod --users 1000 --rate 0 --updates 5000 --workers 16 --skew 1.2
+
+    Report shows dispatcher queueing delay (update queue -> worker queue), worker queueing delay (worker queue ->
+    handler), handler time, end-to-end latency (injection -> handler return), worker saturation and queue depths.
+    Replies are sent with rate limits of the configuration, their queueing delay is reported by send queue stats.
+    mongomock storage is not thread-safe, so it runs with one worker only. Use --backend mongod to find worker count
+    and lock contention
+"""
+import time
+import random
+import argparse
+from collections import Counter
+from threading import Thread, Event
+from benchmarks.stats import summary, percentile, offline_environment
+from benchmarks.fake_telegram import FakeTelegram, command_update, callback_update, photo_update
+from benchmarks.handlers import Bench, MONGOD_URL, MONGOMOCK_URL
+
+DEFAULT_MIX = 'current=1,dirs=1,goto=3,back=2,show=2,find=1,album=1'
+SAMPLE_INTERVAL = 0.05
+
+
+class SimulatedUsers:
+    """ Stream of updates of simulated users, who walk seeded directory trees. Every user keeps its current
+        directory, so generated commands and callbacks are valid for the state, handlers will have
+    """
+    def __init__(self, bench: Bench, mix: dict, skew: float, album_size: int):
+        self.bench = bench
+        self.operations = list(mix)
+        self.operation_weights = [mix[operation] for operation in self.operations]
+        # Zipf-like activity of users: rank ** -skew, 0 makes all users equally active
+        self.user_weights = [(rank + 1) ** -skew for rank in range(len(bench.users))]
+        self.album_size = album_size
+        self.current = {}
+        self.update_id = 0
+        self.file_number = 0
+        self.albums = 0
+
+    def next_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def updates(self, user_id: int) -> list:
+        """ Build updates of the next action of the user
+        """
+        from app import callbacks
+        from app.config import ROOT_DIRECTORY, DIRECTORY_ACTIONS
+
+        if user_id not in self.current:
+            # the first command sets root directory to chat data of the user
+            self.current[user_id] = ROOT_DIRECTORY
+            return [command_update(self.next_id(), user_id, '/current')]
+
+        current = self.current[user_id]
+        children = self.bench.children[user_id].get(current) or []
+        parent = self.bench.parents[user_id].get(current)
+        operation = random.choices(self.operations, self.operation_weights)[0]
+        if operation == 'goto' and children:
+            child = random.choice(children)
+            self.current[user_id] = child
+            ids = self.bench.ids[user_id]
+            return [
+                command_update(self.next_id(), user_id, '/goto'),
+                callback_update(
+                    self.next_id(),
+                    user_id,
+                    callbacks.sign(DIRECTORY_ACTIONS['goto'], user_id, ids[child], ids[current])
+                ),
+            ]
+        if operation == 'back' and parent:
+            self.current[user_id] = parent
+            return [command_update(self.next_id(), user_id, '/back')]
+        if operation == 'show':
+            return [command_update(self.next_id(), user_id, '/show')]
+        if operation == 'find':
+            return [command_update(self.next_id(), user_id, '/find dir_1')]
+        if operation == 'album':
+            self.albums += 1
+            media_group_id = f'album_{self.albums}'
+            updates = []
+            for _ in range(self.album_size):
+                self.file_number += 1
+                updates.append(photo_update(self.next_id(), user_id, self.file_number, media_group_id))
+            return updates
+        if operation == 'dirs':
+            return [command_update(self.next_id(), user_id, '/dirs')]
+
+        return [command_update(self.next_id(), user_id, '/current')]
+
+    def __iter__(self):
+        while True:
+            user_id = random.choices(self.bench.users, self.user_weights)[0]
+            yield from self.updates(user_id)
+
+
+class QueueSampler(Thread):
+    """ Thread, that periodically samples depth of dispatcher and worker queues and amount of busy workers
+    """
+    def __init__(self, dispatcher, pool):
+        super().__init__(name='queue_sampler', daemon=True)
+        self.dispatcher = dispatcher
+        self.pool = pool
+        self.samples = []
+        self._stopped = Event()
+
+    def run(self):
+        while not self._stopped.wait(SAMPLE_INTERVAL):
+            self.samples.append((self.dispatcher.update_queue.qsize(), self.pool.queue_depth(), self.pool.busy))
+
+    def stop(self) -> dict:
+        self._stopped.set()
+        self.join()
+        if not self.samples:
+            return {}
+
+        update_queue, worker_queues, busy = zip(*self.samples)
+        return {
+            'update_queue_max': max(update_queue),
+            'worker_queues_p99': percentile(list(worker_queues), 99),
+            'worker_queues_max': max(worker_queues),
+            'busy_workers_avg': round(sum(busy) / len(busy), 2),
+        }
+
+
+def traced_pool(workers: int, dispatcher, timings: dict, errors: Counter):
+    """ Build worker pool, that records when every update was enqueued, started and finished and counts errors
+        of handlers by type
+    """
+    from app.workers import KeyedWorkerPool
+
+    class TracedPool(KeyedWorkerPool):
+        def handle(self, callback, update, context, enqueued: float):
+            def __traced(update, context):
+                try:
+                    callback(update, context)
+                except Exception as error:
+                    errors[type(error).__name__] += 1
+                    raise
+
+            started = time.perf_counter()
+            super().handle(__traced, update, context, enqueued)
+            # events, that bot puts to the update queue itself, e.g. closed albums, aren't injected
+            if hasattr(update, 'update_id'):
+                timings[update.update_id] = (enqueued, started, time.perf_counter())
+
+    return TracedPool(workers, dispatcher)
+
+
+def wait_for(condition, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+
+    return True
+
+
+def run_load(args) -> dict:
+    fake = FakeTelegram(latency=args.latency)
+    fake.start()
+    offline_environment(
+        TELEGRAM_API_URL=fake.base_url,
+        WORKERS=args.workers,
+        PERSISTENCE_ENABLED='false',
+        MONGO_CONNECTION_URL=MONGOMOCK_URL if args.backend == 'mongomock' else args.mongo_url,
+    )
+    from telegram import Update
+    from app.config import ALBUM_WINDOW
+    import run
+
+    bench = Bench(args.users, args.depth, args.fan_out, args.files)
+    bench.seed()
+
+    timings = {}
+    errors = Counter()
+    updater, dispatcher, _ = run.set_up()
+    pool = traced_pool(args.workers, dispatcher, timings, errors)
+    run.register_handlers(dispatcher, pool)
+    updater.bot.scheduler.start()
+    pool.start()
+    updater.job_queue.start()
+    dispatcher_thread = Thread(target=dispatcher.start, name='dispatcher', daemon=True)
+    dispatcher_thread.start()
+    # bot username is requested by command handlers on the first command, so it is not a part of measurement
+    updater.bot.get_me()
+
+    mix = dict((name, float(weight)) for name, weight in (part.split('=') for part in args.mix.split(',')))
+    users = SimulatedUsers(bench, mix, args.skew, args.album_size)
+    sampler = QueueSampler(dispatcher, pool)
+    injected = {}
+    sampler.start()
+    started = time.perf_counter()
+    for number, data in enumerate(users):
+        if number >= args.updates:
+            break
+        update = Update.de_json(data, updater.bot)
+        if args.rate:
+            delay = started + number / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        injected[update.update_id] = time.perf_counter()
+        dispatcher.update_queue.put(update)
+    injection_duration = time.perf_counter() - started
+
+    completed = wait_for(lambda: len(timings) >= len(injected), args.timeout)
+    duration = time.perf_counter() - started
+    queues = sampler.stop()
+    # albums are saved after the album window, replies are sent by the scheduler after handlers return
+    time.sleep(ALBUM_WINDOW + 0.1)
+    wait_for(lambda: not updater.bot.scheduler.stats()['queue_depth'], args.timeout)
+
+    dispatcher.stop()
+    updater.job_queue.stop()
+    pool.stop()
+    updater.bot.scheduler.stop()
+    fake.stop()
+
+    dispatch_delays, worker_delays, handler_times, latencies = [], [], [], []
+    for update_id, (enqueued, handler_started, finished) in timings.items():
+        dispatch_delays.append(enqueued - injected[update_id])
+        worker_delays.append(handler_started - enqueued)
+        handler_times.append(finished - handler_started)
+        latencies.append(finished - injected[update_id])
+
+    def __ms(values: list) -> dict:
+        return {'p50': round(percentile(values, 50) * 1000, 2), 'p99': round(percentile(values, 99) * 1000, 2)}
+
+    pool_stats = pool.stats()
+    report = {
+        'backend': args.backend,
+        'workers': args.workers,
+        'users': args.users,
+        'target_rate': args.rate,
+        'injected': len(injected),
+        'injected_per_sec': round(len(injected) / injection_duration, 1) if injection_duration else 0.0,
+        'completed': completed,
+    }
+    report.update(summary(latencies, duration))
+    report.update({
+        'dispatch_delay_ms': __ms(dispatch_delays),
+        'worker_delay_ms': __ms(worker_delays),
+        'handler_ms': __ms(handler_times),
+        'saturation': round(pool_stats['busy_seconds'] / (max(args.workers, 1) * duration), 3) if duration else 0.0,
+        'queues': queues,
+        'send': updater.bot.scheduler.stats(),
+        'bot_calls': len(fake.calls),
+        'errors': dict(errors),
+    })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay synthetic updates of many users through the dispatcher')
+    parser.add_argument('--backend', choices=('mongomock', 'mongod'), default='mongomock')
+    parser.add_argument('--mongo-url', default=MONGOD_URL, help='Connection URL of mongod backend')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--updates', type=int, default=5000, help='Amount of injected updates')
+    parser.add_argument('--rate', type=float, default=300, help='Injected updates per second, 0 for no limit')
+    parser.add_argument('--workers', type=int, help='Size of worker pool, 8 with mongod, 1 with mongomock')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Weights of user actions')
+    parser.add_argument('--skew', type=float, default=1.0, help='Zipf exponent of user activity, 0 for uniform')
+    parser.add_argument('--album-size', type=int, default=4)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--fan-out', type=int, default=3)
+    parser.add_argument('--files', type=int, default=5, help='Amount of seeded files in every directory')
+    parser.add_argument('--latency', type=float, default=0.0, help='Bot API answer delay of fake server, seconds')
+    parser.add_argument('--timeout', type=float, default=120, help='Seconds to wait for handling of injected updates')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if args.backend == 'mongomock':
+        if args.workers not in (None, 1):
+            parser.error('mongomock storage is not thread-safe, use --backend mongod to run several workers')
+        args.workers = 1
+    elif args.workers is None:
+        args.workers = 8
+
+    random.seed(args.seed)
+    for key, value in run_load(args).items():
+        print(f'{key}: {value}')
+
+
+if __name__ == '__main__':
+    main()
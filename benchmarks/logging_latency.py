@@ -0,0 +1,82 @@
+""" Latency of logging calls, made by handler threads, with synchronous JSON file and console handlers and with the
+    same handlers behind the bounded queue (see app.logs). Log files are written to a temporary directory.
+
+    python -m benchmarks.logging_latency --records 20000 --threads 8
+"""
+import os
+import time
+import logging
+import argparse
+import tempfile
+from threading import Thread
+from logging.handlers import RotatingFileHandler
+from benchmarks.stats import summary, offline_environment
+
+
+def build_logger(name: str, log_dir: str, rotation_size: int):
+    from app.config import CustomisedJSONFormatter
+
+    logger = logging.getLogger(f'benchmark.{name}')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    formatter = CustomisedJSONFormatter()
+    file_handler = RotatingFileHandler(os.path.join(log_dir, f'{name}.log'), maxBytes=rotation_size, backupCount=3)
+    console_handler = logging.StreamHandler(open(os.devnull, 'w'))
+    for handler in (file_handler, console_handler):
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    return logger
+
+
+def run_mode(queued: bool, records: int, threads: int, rotation_size: int, queue_size: int,
+             sample_rate: float) -> dict:
+    from app.logs import install_queue
+
+    log_dir = tempfile.mkdtemp(prefix='telegram_cloud_logs_')
+    logger = build_logger('queued' if queued else 'sync', log_dir, rotation_size)
+    queue_handler = install_queue(logger, queue_size, sample_rate) if queued else None
+
+    latencies = [[] for _ in range(threads)]
+
+    def __log(number: int):
+        for record in range(records // threads):
+            started = time.perf_counter()
+            logger.info(f'Handled update {record} of worker {number}: current directory is ROOT')
+            latencies[number].append(time.perf_counter() - started)
+
+    workers = [Thread(target=__log, args=(number,)) for number in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    duration = time.perf_counter() - started
+
+    report = {'mode': 'queued' if queued else 'sync', 'threads': threads}
+    report.update(summary([latency for values in latencies for latency in values], duration))
+    if queue_handler:
+        report['dropped'] = queue_handler.dropped
+        drain_started = time.perf_counter()
+        queue_handler.listener.stop()
+        report['drain_ms'] = round((time.perf_counter() - drain_started) * 1000, 1)
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure latency of logging calls with and without queue')
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--rotation-size', type=int, default=100000, help='Log file rotation size, bytes')
+    parser.add_argument('--queue-size', type=int, default=10000)
+    parser.add_argument('--sample-rate', type=float, default=1.0)
+    args = parser.parse_args()
+
+    offline_environment(APP_LOG_QUEUE_ENABLED='false')
+    for queued in (False, True):
+        print(run_mode(queued, args.records, args.threads, args.rotation_size, args.queue_size, args.sample_rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+""" Offline load test of update serving modes. The bot is started against local fake Telegram server and handles
+    /current command, that doesn't touch the database, so the result shows dispatching and sending capacity only.
+    Replies are sent with rate limits of the configuration (SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST).
+
+    python -m benchmarks.serving_modes --mode both --updates 2000 --users 200 --workers 8
+"""
+import sys
+import time
+import socket
+import argparse
+import subprocess
+from collections import defaultdict, deque
+from benchmarks.stats import summary, offline_environment
+from benchmarks.fake_telegram import FakeTelegram, command_update
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_mode(mode: str, updates: int, users: int, workers: int, latency: float) -> dict:
+    fake = FakeTelegram(latency=latency)
+    fake.start()
+    port = free_port()
+    offline_environment(
+        TELEGRAM_API_URL=fake.base_url,
+        WORKERS=workers,
+        WEBHOOK_PORT=port,
+        WEBHOOK_URL_PATH='webhook',
+        WEBHOOK_URL=f'http://127.0.0.1:{port}/webhook',
+        SEND_MERGE_MESSAGES='false',
+        PERSISTENCE_ENABLED='false',
+    )
+    import run
+
+    updater, dispatcher, pool = run.set_up()
+    run.register_handlers(dispatcher, pool)
+    run.start(updater, pool, mode)
+    if mode == 'webhook':
+        while not fake.webhook_url:
+            time.sleep(0.05)
+
+    pushed = defaultdict(deque)
+    started = time.monotonic()
+    for number in range(updates):
+        user_id = 1000 + number % users
+        pushed[user_id].append(time.monotonic())
+        fake.push_update(command_update(number + 1, user_id, '/current'))
+
+    completed = fake.wait_for_calls(updates, 'sendMessage')
+    duration = time.monotonic() - started
+    run.stop(updater, pool)
+    fake.stop()
+
+    latencies = []
+    for call in fake.calls_of('sendMessage'):
+        latencies.append(call['time'] - pushed[int(call['payload']['chat_id'])].popleft())
+
+    report = {'mode': mode, 'workers': workers, 'completed': completed}
+    report.update(summary(latencies, duration))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of polling and webhook serving modes')
+    parser.add_argument('--mode', choices=('polling', 'webhook', 'both'), default='both')
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.0, help='Bot API answer delay of fake server, seconds')
+    args = parser.parse_args()
+
+    if args.mode == 'both':
+        # every mode runs in its own process, as updater and dispatcher are process-wide singletons
+        for mode in ('polling', 'webhook'):
+            command = [sys.executable, '-m', 'benchmarks.serving_modes', '--mode', mode]
+            for name in ('updates', 'users', 'workers', 'latency'):
+                command += [f'--{name}', str(getattr(args, name))]
+            subprocess.run(command, check=True)
+    else:
+        print(run_mode(args.mode, args.updates, args.users, args.workers, args.latency))
+
+
+if __name__ == '__main__':
+    main()
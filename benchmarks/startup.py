@@ -0,0 +1,75 @@
+""" Cold start benchmark: time from process start to the first handled update of run.py bot, served by long polling
+    from local fake Telegram server. Every run is made in a fresh process.
+
+    python -m benchmarks.startup --runs 5
+"""
+import time
+
+STARTED = time.perf_counter()
+
+# the rest of imports go after start time is taken
+import sys
+import json
+import argparse
+import subprocess
+from benchmarks.stats import percentile, offline_environment
+from benchmarks.fake_telegram import FakeTelegram, command_update
+
+
+def measure() -> dict:
+    """ Start the bot in current process and measure start up phases, seconds since process start
+    """
+    fake = FakeTelegram()
+    fake.start()
+    offline_environment(TELEGRAM_API_URL=fake.base_url, PERSISTENCE_ENABLED='false', WORKERS=2)
+    timings = {}
+
+    import app.config
+    timings['import_config'] = time.perf_counter() - STARTED
+    import run
+    timings['import_run'] = time.perf_counter() - STARTED
+
+    updater, dispatcher, pool = run.set_up()
+    run.register_handlers(dispatcher, pool)
+    run.start(updater, pool, 'polling')
+    timings['started'] = time.perf_counter() - STARTED
+
+    fake.push_update(command_update(1, 1000, '/current'))
+    fake.wait_for_calls(1, 'sendMessage')
+    timings['first_update'] = time.perf_counter() - STARTED
+
+    # cost, that is paid lazily on the first encryption instead of start up
+    derivation_started = time.perf_counter()
+    app.config.CRYPTO.key
+    timings['key_derivation'] = time.perf_counter() - derivation_started
+
+    run.stop(updater, pool)
+    fake.stop()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure time from process start to the first handled update')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure()))
+        return
+
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.startup', '--child'],
+            check=True, stdout=subprocess.PIPE, universal_newlines=True
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    for phase in runs[0]:
+        values = [timings[phase] for timings in runs]
+        print(f'{phase}: p50={percentile(values, 50) * 1000:.1f}ms max={max(values) * 1000:.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+import os
+
+
+def percentile(values: list, percent: float) -> float:
+    """ Get percentile of values using nearest-rank method
+    """
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(percent / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def summary(values: list, duration: float) -> dict:
+    """ Build throughput and latency report
+
+    :param values: latencies of operations in seconds
+    :param duration: total duration of benchmark in seconds
+    :return: amount of operations, operations per second and p50/p99 latency in milliseconds
+    """
+    return {
+        'ops': len(values),
+        'ops_per_sec': round(len(values) / duration, 1) if duration else 0.0,
+        'p50_ms': round(percentile(values, 50) * 1000, 2),
+        'p99_ms': round(percentile(values, 99) * 1000, 2),
+    }
+
+
+def offline_environment(**overrides):
+    """ Fill environment variables, required by app.config, with placeholders, so app could be imported offline.
+        Must be called before the first import of app package
+    """
+    defaults = {
+        'TOKEN': '123456:offline-benchmark-token',
+        'SECRET_KEY': 'offline-benchmark-secret',
+        'SALT': 'offline-benchmark-salt',
+        'MONGO_USER': 'benchmark',
+        'MONGO_PASSWORD': 'benchmark',
+        'MONGO_HOST': 'localhost',
+        'MONGO_PORT': '27017',
+        'MONGO_DB_NAME': 'telegram_cloud_benchmark',
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+    for name, value in overrides.items():
+        os.environ[name] = str(value)
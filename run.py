@@ -1,69 +1,249 @@
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler
-from app import logger
-from app.config import TOKEN
-from app.handlers import BaseHandlers, FileSystemHandlers, MediaHandlers
+import re
+import signal
+from threading import Thread
+from telegram import Update
+from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler, TypeHandler
+from telegram.utils.request import Request
+from app import logger, log_queue
+from app.config import (TOKEN, STATS_LOG_INTERVAL, MEDIA_ACTIONS, SEARCH_ACTIONS, DIRECTORY_ACTIONS, SEND_GLOBAL_RATE,
+                        SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_CONCURRENCY, SEND_MERGE_MESSAGES, UPDATE_MODE, WORKERS,
+                        CONNECTION_POOL_SIZE, TELEGRAM_API_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_URL_PATH,
+                        WEBHOOK_URL, PERSISTENCE_ENABLED, PERSISTENCE_FLUSH_INTERVAL, METRICS_HOST, METRICS_PORT,
+                        SHARDS, SHARD_QUEUE_SIZE)
+from app.handlers import (PreProcessors, BaseHandlers, FileSystemHandlers, MediaHandlers, SearchHandlers,
+                          BackupHandlers)
+from app.models import DIRECTORY_CACHE, DECRYPT_CACHE, SEARCH_CACHE
+from app.albums import ALBUM_BUFFER, AlbumReady
+from app.callbacks import SEPARATOR as CALLBACK_SEPARATOR
+from app.metrics import METRICS, MetricsServer
+from app.sender import SendScheduler, ScheduledBot
+from app.workers import KeyedWorkerPool
+from app.persistence import MongoPersistence
+from app.sharding import ShardRouter
 
 
-def set_up():
+def set_up(persistence_enabled: bool = PERSISTENCE_ENABLED, global_rate: float = SEND_GLOBAL_RATE):
     """ Setting up bot internal services during start up
+
+    :param persistence_enabled: keep conversation state in MongoDB
+    :param global_rate: messages per second, that the process could send to all chats
     """
-    updater = Updater(TOKEN, use_context=True)
+    scheduler = SendScheduler(
+        global_rate, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_CONCURRENCY, SEND_MERGE_MESSAGES
+    )
+    bot = ScheduledBot(
+        TOKEN,
+        base_url=TELEGRAM_API_URL,
+        request=Request(con_pool_size=CONNECTION_POOL_SIZE),
+        scheduler=scheduler
+    )
+    persistence = MongoPersistence(PERSISTENCE_FLUSH_INTERVAL) if persistence_enabled else None
+    updater = Updater(bot=bot, persistence=persistence, use_context=True)
     dp = updater.dispatcher
+    pool = KeyedWorkerPool(WORKERS, dp)
 
-    return updater, dp
+    METRICS.collect('directory_cache', DIRECTORY_CACHE.stats)
+    METRICS.collect('decrypt_cache', DECRYPT_CACHE.stats)
+    METRICS.collect('search_cache', SEARCH_CACHE.stats)
+    METRICS.collect('send_queue', scheduler.stats)
+    METRICS.collect('workers', pool.stats)
+    METRICS.collect('albums', lambda: {'buffered': len(ALBUM_BUFFER)})
+    if persistence:
+        METRICS.collect('persistence', persistence.stats)
+    if log_queue:
+        METRICS.collect('log_queue', log_queue.stats)
 
+    return updater, dp, pool
 
-def main():
-    """ Main function that runs bot
+
+def register_handlers(dispatcher, pool):
+    """ Register bot commands, message and callback handlers
     """
-    updater, dispatcher = set_up()
+    def __handler(callback):
+        """ Run callback in the pool of handler workers and record its metrics
+        """
+        return pool.wrap(PreProcessors.instrument(callback))
 
     ###########################################################################
     # Commands
     ###########################################################################
-    dispatcher.add_handler(CommandHandler("start", BaseHandlers.start))
-    dispatcher.add_handler(CommandHandler("help", BaseHandlers.help))
+    dispatcher.add_handler(CommandHandler("start", __handler(BaseHandlers.start)))
+    dispatcher.add_handler(CommandHandler("help", __handler(BaseHandlers.help)))
     dispatcher.add_handler(CommandHandler(
         "create",
-        FileSystemHandlers.create_directory,
+        __handler(FileSystemHandlers.create_directory),
         pass_args=True,
         pass_job_queue=True,
         pass_chat_data=True
     ))
     dispatcher.add_handler(CommandHandler(
         "delete",
-        FileSystemHandlers.remove_directory,
+        __handler(FileSystemHandlers.remove_directory),
         pass_args=True
     ))
     dispatcher.add_handler(CommandHandler(
         "current",
-        FileSystemHandlers.current_directory,
+        __handler(FileSystemHandlers.current_directory),
         pass_job_queue=True,
         pass_chat_data=True
     ))
     dispatcher.add_handler(CommandHandler(
         "dirs",
-        FileSystemHandlers.show_subdirectories
+        __handler(FileSystemHandlers.show_subdirectories)
     ))
-    dispatcher.add_handler(CommandHandler("show", MediaHandlers.show_photo))
-    dispatcher.add_handler(CommandHandler("goto", FileSystemHandlers.go_to_directory))
-    dispatcher.add_handler(CommandHandler("back", FileSystemHandlers.return_to_parent_directory))
+    dispatcher.add_handler(CommandHandler("show", __handler(MediaHandlers.show_photo)))
+    dispatcher.add_handler(CommandHandler("goto", __handler(FileSystemHandlers.go_to_directory)))
+    dispatcher.add_handler(CommandHandler("back", __handler(FileSystemHandlers.return_to_parent_directory)))
+    dispatcher.add_handler(CommandHandler("move", __handler(FileSystemHandlers.move_directory)))
+    dispatcher.add_handler(CommandHandler("rename", __handler(FileSystemHandlers.rename_directory)))
+    dispatcher.add_handler(CommandHandler("stats", __handler(MediaHandlers.show_stats)))
+    dispatcher.add_handler(CommandHandler("find", __handler(SearchHandlers.find)))
+    dispatcher.add_handler(CommandHandler("export", __handler(BackupHandlers.export)))
+    dispatcher.add_handler(CommandHandler("import", __handler(BackupHandlers.import_tree)))
     ###########################################################################
     # Message handlers
     ###########################################################################
-    dispatcher.add_handler(MessageHandler(Filters.photo, MediaHandlers.save_photo))
+    dispatcher.add_handler(MessageHandler(
+        Filters.photo | Filters.video | Filters.document | Filters.audio | Filters.voice,
+        __handler(MediaHandlers.save_media)
+    ))
+    # albums are saved, when their window is over, by events from the job queue
+    dispatcher.add_handler(TypeHandler(AlbumReady, __handler(MediaHandlers.save_album)))
     ###########################################################################
     # Callback handlers
     ###########################################################################
-    dispatcher.add_handler(CallbackQueryHandler(FileSystemHandlers.process_keyboard))
+    dispatcher.add_handler(CallbackQueryHandler(
+        __handler(MediaHandlers.show_photo_page),
+        pattern=f"^{MEDIA_ACTIONS['show']}{re.escape(CALLBACK_SEPARATOR)}"
+    ))
+    dispatcher.add_handler(CallbackQueryHandler(
+        __handler(SearchHandlers.find_page),
+        pattern=f"^{SEARCH_ACTIONS['page']},"
+    ))
+    dispatcher.add_handler(CallbackQueryHandler(
+        __handler(SearchHandlers.jump_to_directory),
+        pattern=f"^{SEARCH_ACTIONS['jump']},"
+    ))
+    dispatcher.add_handler(CallbackQueryHandler(
+        __handler(FileSystemHandlers.process_keyboard_page),
+        pattern=f"^[{DIRECTORY_ACTIONS['next']}{DIRECTORY_ACTIONS['previous']}]"
+                f"[{DIRECTORY_ACTIONS['goto']}{DIRECTORY_ACTIONS['delete']}]{re.escape(CALLBACK_SEPARATOR)}"
+    ))
+    dispatcher.add_handler(CallbackQueryHandler(__handler(FileSystemHandlers.process_keyboard)))
     ###########################################################################
     # Error handlers
     ###########################################################################
     dispatcher.add_error_handler(BaseHandlers.error)
     ###########################################################################
 
-    updater.start_polling()
+
+def register_jobs(updater, resume_interrupted: bool = True):
+    """ Register background jobs
+
+    :param updater: Telegram updater
+    :param resume_interrupted: finish interrupted directory moves and deletions. Only one of worker processes does it
+    """
+    if resume_interrupted:
+        updater.job_queue.run_once(BaseHandlers.resume_pending_moves, when=0)
+        updater.job_queue.run_once(BaseHandlers.resume_pending_deletes, when=0)
+    updater.job_queue.run_repeating(BaseHandlers.log_stats, interval=STATS_LOG_INTERVAL, context=updater.dispatcher)
+
+
+def start(updater, pool, mode: str = UPDATE_MODE, metrics_port: int = METRICS_PORT):
+    """ Start sending of outgoing messages, handler workers and receiving of updates
+
+    :param updater: Telegram updater
+    :param pool: pool of handler workers
+    :param mode: the way updates are received: 'polling' or 'webhook'. None starts only the dispatcher, updates
+        are put to its queue by the caller
+    :param metrics_port: port of metrics server, 0 to disable it
+    """
+    if metrics_port:
+        MetricsServer(METRICS_HOST, metrics_port).start()
+    updater.bot.scheduler.start()
+    pool.start()
+    if updater.persistence:
+        updater.persistence.start()
+    if mode == 'webhook':
+        updater.start_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_URL_PATH,
+            webhook_url=WEBHOOK_URL
+        )
+        # updater registers the webhook only if it terminates SSL itself, here it is done by a proxy
+        updater.bot.set_webhook(WEBHOOK_URL)
+    elif mode == 'polling':
+        updater.start_polling()
+    else:
+        updater.job_queue.start()
+        Thread(target=updater.dispatcher.start, name='dispatcher', daemon=True).start()
+
+
+def stop(updater, pool):
+    """ Stop receiving updates, wait until queued updates are handled and replies are sent and save
+        conversation state
+    """
+    webhook = updater.httpd is not None
+    updater.stop()
+    if webhook:
+        updater.bot.delete_webhook()
+    # dispatcher, that was started without receiving of updates, is not stopped by updater
+    if updater.dispatcher.running:
+        updater.dispatcher.stop()
+    pool.stop()
+    updater.bot.scheduler.stop()
+    if updater.persistence:
+        updater.persistence.stop()
+
+
+def serve_shard(number: int, queue):
+    """ Handle updates of one shard in worker process, until None is received from the queue
+
+    :param number: number of shard
+    :param queue: queue of update dicts, forwarded by the front process
+    """
+    # the front process stops workers on its own, after forwarded updates are handled
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # global flood limit of the bot is shared by all worker processes, while a chat is sent to by one of them only
+    updater, dispatcher, pool = set_up(global_rate=SEND_GLOBAL_RATE / SHARDS)
+    register_handlers(dispatcher, pool)
+    register_jobs(updater, resume_interrupted=number == 0)
+    start(updater, pool, mode=None, metrics_port=METRICS_PORT + number + 1 if METRICS_PORT else 0)
+    logger.info(f'Worker process of shard {number} has started')
+    while True:
+        data = queue.get()
+        if data is None:
+            break
+        dispatcher.update_queue.put(Update.de_json(data, updater.bot))
+
+    stop(updater, pool)
+
+
+def main():
+    """ Main function that runs bot. With several shards this process only receives updates and forwards them to
+        worker processes
+    """
+    if SHARDS > 1:
+        router = ShardRouter(SHARDS, SHARD_QUEUE_SIZE, serve_shard)
+        router.start()
+        updater, dispatcher, pool = set_up(persistence_enabled=False)
+        router.register(dispatcher)
+        dispatcher.add_error_handler(BaseHandlers.error)
+        METRICS.collect('shards', router.stats)
+        start(updater, pool)
+        updater.idle()
+        stop(updater, pool)
+        router.stop()
+        return
+
+    updater, dispatcher, pool = set_up()
+    register_handlers(dispatcher, pool)
+    register_jobs(updater)
+    start(updater, pool)
     updater.idle()
+    stop(updater, pool)
 
 
 if __name__ == '__main__':